@@ -32,14 +32,14 @@ async def register(data: RegisterRequest):
     user_data.setdefault("email", "")
     user_data.setdefault("bio", "")
     user_data.setdefault("profile_image_url", "")
-    if register_user(user_data):
+    if await register_user(user_data):
         return {"message": "User registered successfully!"}
     raise HTTPException(status_code=400, detail="User already exists")
 
 
 @router.post("/login/")
 async def login(data: LoginRequest):
-    user = authenticate_user(data.phone_number, data.password)
+    user = await authenticate_user(data.phone_number, data.password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     token = create_access_token(user)
@@ -0,0 +1,323 @@
+"""Micro-benchmarks for hot paths, without sockets or a running server.
+
+    python bench.py                 # every benchmark
+    python bench.py codec typing    # just these
+    python bench.py typing --typists 10000
+    python bench.py --list
+
+Benchmarks that touch MongoDB use a throwaway database (LOADTEST_DB) on MONGODB_URI, as
+loadtest.py does; the rest are pure Python. End-to-end numbers over real sockets come
+from loadtest.py.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import asyncio
+import argparse
+from datetime import datetime, timezone
+
+# Must be set before the app modules are imported
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ["MONGODB_DB"] = os.getenv("LOADTEST_DB", "chitchat_loadtest")
+os.environ.setdefault("MONGODB_TRANSACTIONS", "0")
+os.environ.pop("MESSAGE_BUS_URL", None)
+
+BENCHMARKS = []
+
+def benchmark(name: str):
+    def register(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+def per_call_us(fn, repeat: int = 3) -> float:
+    """Best-of-`repeat` microseconds per call, with the loop count picked by timeit."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return round(min(timer.repeat(repeat=repeat, number=number)) / number * 1e6, 2)
+
+def phone_for(i: int) -> str:
+    return f"+91{9000000000 + i}"
+
+def sample_frames() -> dict:
+    message = {
+        "type": "message",
+        "from": phone_for(1),
+        "to": phone_for(2),
+        "message": "Are we still on for tonight? I can pick you up around 8.",
+        "message_id": f"{phone_for(1)}_{phone_for(2)}_1760000000.123456",
+        "time": "2026-10-17T12:00:00.123456+00:00",
+    }
+    return {
+        "message": message,
+        "delivery_receipt": {"type": "delivery_receipt", "message_id": message["message_id"], "status": "delivered", "client_temp_id": "tmp-1"},
+        "typing": {"type": "typing", "from": phone_for(1), "is_typing": True},
+        "presence": {"type": "presence", "phone_number": phone_for(1), "online": True, "last_seen": message["time"]},
+        "friends_update_100": {"type": "friends_update", "friends": [{
+            "phone_number": phone_for(i),
+            "username": f"user{i:06d}",
+            "profile_image_url": f"https://example.com/profile_images/{i}.jpeg",
+            "online": i % 3 == 0,
+            "unread": i % 5,
+            "last_message": message["message"],
+            "last_message_time": message["time"],
+            "last_message_status": "delivered",
+        } for i in range(100)], "groups": {}},
+        "message_batch_200": {"type": "message_batch", "messages": [message] * 200, "cursor": "eyJ0IjoiMjAyNiJ9"},
+    }
+
+@benchmark("codec")
+def bench_codec(args) -> dict:
+    """Encode/decode cost and size per frame type and codec, plus shared vs. per-socket encoding on fan-out."""
+    import codec
+    from codec import Frame
+
+    codecs = dict(codec.CODECS)
+    if codec.orjson is not None:
+        # What JsonCodec costs without orjson
+        codecs["stdlib_json"] = type("StdlibJson", (), {
+            "name": "stdlib_json", "binary": False, "encode": staticmethod(json.dumps), "decode": staticmethod(json.loads)
+        })()
+
+    frames = sample_frames()
+    results = {}
+    for frame_type, obj in frames.items():
+        row = {}
+        for name, frame_codec in codecs.items():
+            encoded = frame_codec.encode(obj)
+            row[name] = {
+                "encode_us": per_call_us(lambda: frame_codec.encode(obj)),
+                "decode_us": per_call_us(lambda: frame_codec.decode(encoded)),
+                "bytes": len(encoded) if frame_codec.binary else len(encoded.encode()),
+            }
+        results[frame_type] = row
+
+    # One presence change going to 100 friends
+    presence = frames["presence"]
+
+    def shared():
+        frame = Frame(presence)
+        for _ in range(100):
+            frame.encode(codec.JSON)
+
+    def per_socket():
+        for _ in range(100):
+            codec.JSON.encode(presence)
+
+    results["fan_out_100"] = {"shared_frame_us": per_call_us(shared), "per_socket_us": per_call_us(per_socket)}
+    return results
+
+@benchmark("typing")
+async def bench_typing(args) -> dict:
+    """Frames in vs. frames forwarded by TypingRelay with --typists clients sending a frame per keystroke."""
+    import random
+    from typing_indicators import TypingRelay
+
+    forwarded = {True: 0, False: 0}
+
+    async def send(sender, receiver, is_typing):
+        forwarded[is_typing] += 1
+
+    relay = TypingRelay(send)
+    await relay.start()
+    stop = asyncio.Event()
+    inbound = 0
+    update_seconds = 0.0
+
+    async def update(sender, receiver, is_typing):
+        nonlocal inbound, update_seconds
+        started = time.perf_counter()
+        await relay.update(sender, receiver, is_typing)
+        update_seconds += time.perf_counter() - started
+        inbound += 1
+
+    async def typist(i):
+        sender, receiver = phone_for(i), phone_for(i + 1)
+        await asyncio.sleep(random.random() * 2)
+        while not stop.is_set():
+            # A burst of keystrokes, then either an explicit stop or just going quiet
+            for _ in range(random.randint(3, 30)):
+                await update(sender, receiver, True)
+                await asyncio.sleep(random.uniform(0.05, 0.3))
+            if random.random() < 0.7:
+                await update(sender, receiver, False)
+            await asyncio.sleep(random.expovariate(0.5))
+
+    typists = [asyncio.create_task(typist(i)) for i in range(args.typists)]
+    started = time.perf_counter()
+    await asyncio.sleep(args.typing_duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    for task in typists:
+        task.cancel()
+    await asyncio.gather(*typists, return_exceptions=True)
+    await relay.stop()
+
+    sent = forwarded[True] + forwarded[False]
+    return {
+        "typists": args.typists,
+        "duration_s": round(elapsed, 1),
+        "inbound_per_sec": round(inbound / elapsed, 1),
+        "forwarded_per_sec": round(sent / elapsed, 1),
+        "forwarded_start": forwarded[True],
+        "forwarded_stop": forwarded[False],
+        "reduction": round(1 - sent / inbound, 3) if inbound else 0.0,
+        "update_us": round(update_seconds / inbound * 1e6, 2) if inbound else 0.0,
+        "relay": relay.stats(),
+    }
+
+def percentiles_ms(samples: list) -> dict:
+    samples = sorted(samples)
+    pick = lambda p: round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 2) if samples else 0.0
+    return {"p50_ms": pick(0.50), "p99_ms": pick(0.99)}
+
+@benchmark("message_writer")
+async def bench_message_writer(args) -> dict:
+    """Stored messages per second and ack latency for MessageWriter, direct vs. batched, durable vs. buffered acks.
+
+    --producers concurrent senders (one conversation each) write as fast as their acks allow.
+    """
+    from models import client, db, chats_collection
+    from conversations import MessageWriter, conversations_collection
+    from migrations import run_migrations
+
+    await client.drop_database(db.name)
+    await run_migrations()
+    # Direct writes always wait for the database, so the ack mode only matters when batched
+    configs = {
+        "direct": MessageWriter(batched=False),
+        "batched_durable": MessageWriter(batched=True, ack_after_buffer=False),
+        "batched_buffered": MessageWriter(batched=True, ack_after_buffer=True),
+    }
+    results = {}
+    try:
+        for name, writer in configs.items():
+            await chats_collection.delete_many({})
+            await conversations_collection.delete_many({})
+            stop = asyncio.Event()
+            acks = []
+
+            async def producer(i):
+                sender, receiver = phone_for(2 * i), phone_for(2 * i + 1)
+                n = 0
+                while not stop.is_set():
+                    n += 1
+                    started = time.perf_counter()
+                    await writer.write({
+                        "_id": f"{sender}_{receiver}_{name}_{n}",
+                        "from": sender,
+                        "to": receiver,
+                        "message": "benchmark message",
+                        "time": datetime.now(timezone.utc).isoformat(),
+                        "status": "sent",
+                        "delivered_at": None,
+                        "read_at": None,
+                    })
+                    acks.append(time.perf_counter() - started)
+                    if writer.ack_after_buffer:
+                        # Buffered acks return at once; yield so the flush can run
+                        await asyncio.sleep(0)
+
+            producers = [asyncio.create_task(producer(i)) for i in range(args.producers)]
+            started = time.perf_counter()
+            await asyncio.sleep(args.writer_duration)
+            stop.set()
+            await asyncio.gather(*producers)
+            await writer.stop()
+            elapsed = time.perf_counter() - started
+            stored = await chats_collection.count_documents({})
+            results[name] = {
+                "messages_per_sec": round(stored / elapsed, 1),
+                "acked": len(acks),
+                "stored": stored,
+                "ack": percentiles_ms(acks),
+            }
+    finally:
+        await client.drop_database(db.name)
+    return {"producers": args.producers, "transactions": os.environ["MONGODB_TRANSACTIONS"] == "1", **results}
+
+def mongo_commands() -> int:
+    from metrics import metrics
+    with metrics._lock:
+        return sum(h.count for (name, _), h in metrics.histograms.items() if name == "mongo_command_seconds")
+
+@benchmark("friends_summary")
+async def bench_friends_summary(args) -> dict:
+    """get_friends_summary latency and database round trips for 10, 100 and 1000 friends, with and without profiles."""
+    from models import client, db, users_collection
+    from conversations import get_friends_summary, conversation_id, conversations_collection
+    from migrations import run_migrations
+
+    sizes = [10, 100, 1000]
+    me = phone_for(0)
+    friends = [phone_for(i) for i in range(1, max(sizes) + 1)]
+    now = datetime.now(timezone.utc).isoformat()
+    await client.drop_database(db.name)
+    await run_migrations()
+    try:
+        await users_collection.insert_many([
+            {"phone_number": phone, "username": f"user{i:06d}", "username_lower": f"user{i:06d}", "bio": "", "email": "",
+             "profile_image_url": "", "friends": [me] if i else friends}
+            for i, phone in enumerate([me] + friends)
+        ])
+        await conversations_collection.insert_many([{
+            "_id": conversation_id(me, friend),
+            "members": sorted((me, friend)),
+            "last_message": "See you tomorrow",
+            "last_message_time": now,
+            "last_message_status": "delivered",
+            "last_message_from": friend,
+            "unread": {me: i % 7},
+        } for i, friend in enumerate(friends)])
+
+        results = {}
+        for size in sizes:
+            for with_profiles in (False, True):
+                timings = []
+                commands_before = mongo_commands()
+                for _ in range(args.summary_calls):
+                    started = time.perf_counter()
+                    await get_friends_summary(me, friends[:size], with_profiles=with_profiles)
+                    timings.append(time.perf_counter() - started)
+                results[f"{size}_friends{'_with_profiles' if with_profiles else ''}"] = {
+                    **percentiles_ms(timings),
+                    "db_commands_per_call": round((mongo_commands() - commands_before) / args.summary_calls, 2),
+                }
+    finally:
+        await client.drop_database(db.name)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    parser.add_argument("--typists", type=int, default=10000, help="simulated typists for the typing benchmark")
+    parser.add_argument("--typing-duration", type=float, default=10, help="seconds of typing traffic")
+    parser.add_argument("--producers", type=int, default=200, help="concurrent senders for the message_writer benchmark")
+    parser.add_argument("--writer-duration", type=float, default=10, help="seconds per message_writer mode")
+    parser.add_argument("--summary-calls", type=int, default=200, help="calls per friends_summary case")
+    args = parser.parse_args()
+
+    known = [name for name, _ in BENCHMARKS]
+    if args.list:
+        print("\n".join(known))
+        sys.exit(0)
+    unknown = set(args.names) - set(known)
+    if unknown:
+        sys.exit(f"Unknown benchmarks: {sorted(unknown)}")
+
+    async def run_all() -> dict:
+        # One event loop for the lot, so the shared Motor client stays on it
+        results = {}
+        for name, fn in BENCHMARKS:
+            if args.names and name not in args.names:
+                continue
+            started = time.perf_counter()
+            result = fn(args)
+            results[name] = await result if asyncio.iscoroutine(result) else result
+            print(f"{name}: {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        return results
+
+    print(json.dumps(asyncio.run(run_all()), indent=2))
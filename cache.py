@@ -0,0 +1,98 @@
+import os
+import time
+import copy
+from collections import OrderedDict
+from connections import registry
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl))
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+# token -> verified phone number, kept no longer than the token's own expiry
+token_cache = TTLCache(int(os.getenv("TOKEN_CACHE_SIZE", "10000")), float(os.getenv("TOKEN_CACHE_TTL", "300")))
+# phone number -> user document
+user_cache = TTLCache(int(os.getenv("USER_CACHE_SIZE", "10000")), float(os.getenv("USER_CACHE_TTL", "60")))
+
+# phone number -> invalidation count at its last invalidation. A read-through only caches
+# the document it loaded if the generation is unchanged, so a write that invalidates while
+# the read is in flight can't be overwritten by the older document.
+_generations = OrderedDict()
+_generation_floor = 0
+_invalidations = 0
+
+def user_generation(phone_number: str) -> int:
+    return _generations.get(phone_number, _generation_floor)
+
+def _bump_generation(phone_number: str):
+    global _generation_floor, _invalidations
+    _invalidations += 1
+    _generations[phone_number] = _invalidations
+    _generations.move_to_end(phone_number)
+    while len(_generations) > user_cache.maxsize:
+        # Forgotten phones fall back to the floor, which only ever moves forward
+        _, evicted = _generations.popitem(last=False)
+        _generation_floor = max(_generation_floor, evicted)
+
+def get_cached_user(phone_number: str):
+    user = user_cache.get(phone_number)
+    # Callers mutate the documents they get back
+    return copy.deepcopy(user) if user is not None else None
+
+def cache_user(user: dict, generation: int):
+    """Cache `user` unless it was invalidated since `generation` was read."""
+    if user_generation(user["phone_number"]) == generation:
+        user_cache.set(user["phone_number"], copy.deepcopy(user))
+
+async def invalidate_user(*phone_numbers: str):
+    """Forget cached user documents here and on every other worker."""
+    for phone_number in phone_numbers:
+        _bump_generation(phone_number)
+        user_cache.pop(phone_number)
+    await registry.broadcast({"type": "invalidate_user", "phone_numbers": list(phone_numbers)})
+
+async def _on_broadcast(event: dict):
+    if event.get("type") == "invalidate_user":
+        for phone_number in event.get("phone_numbers", []):
+            _bump_generation(phone_number)
+            user_cache.pop(phone_number)
+
+registry.add_broadcast_listener(_on_broadcast)
+
+def cache_stats() -> dict:
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
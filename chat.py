@@ -1,62 +1,129 @@
+import time
+import uuid
+import asyncio
 from datetime import datetime, timezone
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
-from typing import Dict, Optional
-import json
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from typing import Optional
 from models import db
+import codec
+from codec import Frame
 from jose import jwt, JWTError
-from fcm_utils import send_fcm_notification
-from models import set_user_online, set_user_offline, chats_collection
+from notifications import NotificationDispatcher
+from models import chats_collection, get_user_by_phone
+import conversations
+from connections import registry
+from presence import PresenceTracker
+from push_scheduler import DebouncedPushScheduler
+from typing_indicators import TypingRelay
+import offline_sync
+import groups
+import retention
+from rate_limit import frame_limiter, rest_limiter, shed, SHEDDABLE_FRAMES
+from metrics import metrics, log, LOG_SAMPLE_RATE
 
 SECRET_KEY = "your_secret_key"
 ALGORITHM = "HS256"
 
 router = APIRouter()
 
-active_connections: Dict[str, WebSocket] = {}
+def record_fcm_metric(name, value):
+    if name == "fcm.dispatch_latency":
+        metrics.observe("fcm_dispatch_latency_seconds", value)
+    else:
+        metrics.set(name.replace(".", "_"), value)
+
+# Push notifications for offline recipients, sent in the background
+notifier = NotificationDispatcher(is_online=registry.is_connected, metrics_hook=record_fcm_metric)
+metrics.gauge("fcm_dropped", lambda: notifier.dropped)
+
+async def send_presence_update(phone_number, online, last_seen, friends):
+    # Encoded once, however many friends it goes to
+    frame = Frame({
+        "type": "presence",
+        "phone_number": phone_number,
+        "online": online,
+        "last_seen": last_seen
+    })
+    for friend in friends:
+        await registry.send(friend, frame)
+
+presence = PresenceTracker(
+    on_change=send_presence_update,
+    is_alive=lambda phone: phone in registry.local and not registry.local[phone].closed
+)
 chats_collection = db["chats"]
-chat_meta_collection = db["chat_meta"]
 
 async def send_friends_update(phone_number):
-    if phone_number in active_connections:
-        await active_connections[phone_number].send_text(json.dumps({
-            "type": "friends_update_trigger"
-        }))
+    await registry.send(phone_number, {
+        "type": "friends_update_trigger"
+    })
 
-async def send_unread_update(user_phone):
-    user_doc = db["users"].find_one({"phone_number": user_phone})
+async def send_unread_update(user_phone, changed=None):
+    """Push the friends summary; only the `changed` conversations (friends or group ids) when given (a delta)."""
+    if not await registry.is_connected(user_phone):
+        return
+    user_doc = await get_user_by_phone(user_phone)
     if not user_doc:
         return
     friends = user_doc.get("friends", [])
-    summary = {}
-    for friend in friends:
-        meta = chat_meta_collection.find_one({"user": user_phone, "friend": friend}) or {}
-        unread = meta.get("unread", 0)
-        # Get last message and time
-        last_msg_doc = chats_collection.find_one(
-            {"$or": [
-                {"from": user_phone, "to": friend},
-                {"from": friend, "to": user_phone}
-            ]},
-            sort=[("time", -1)]
-        )
-        last_message = last_msg_doc["message"] if last_msg_doc else ""
-        last_message_time = last_msg_doc["time"] if last_msg_doc else ""
-        summary[friend] = {
-            "unread": unread,
-            "last_message": last_message,
-            "last_message_time": last_message_time
-        }
-    if user_phone in active_connections:
-        await active_connections[user_phone].send_text(json.dumps({
-            "type": "friends_update",
-            "summary": summary
-        }))
+    group_ids = None
+    if changed is not None:
+        friends = [friend for friend in friends if friend in changed]
+        group_ids = [cid for cid in changed if groups.is_group_id(cid)]
+        if not friends and not group_ids:
+            return
+    summaries = await conversations.get_friends_summary(user_phone, friends)
+    summary = {
+        friend: {
+            "unread": entry["unread"],
+            "last_message": entry["last_message"],
+            "last_message_time": entry["last_message_time"]
+        } for friend, entry in summaries.items()
+    }
+    frame = {
+        "type": "friends_update",
+        "summary": summary,
+        "delta": changed is not None
+    }
+    if group_ids is None or group_ids:
+        frame["groups"] = await groups.get_groups_summary(user_phone, group_ids)
+    await registry.send(user_phone, frame)
+
+# Bursts of messages become one friends_update per user per window
+summary_pushes = DebouncedPushScheduler(send_unread_update)
+metrics.gauge("summary_pushes", summary_pushes.stats)
+
+async def send_typing(sender, receiver, is_typing):
+    typing_message = {
+        "type": "typing",
+        "from": sender,
+        "to": receiver,
+        "is_typing": is_typing
+    }
+    await registry.send(receiver, typing_message, ephemeral=True)
+
+typing_relay = TypingRelay(send_typing)
+metrics.gauge("typing", typing_relay.stats)
+metrics.gauge("ws_connections", lambda: len(registry.local))
+
+# Bounded label set for per-type frame metrics; anything else is counted as "other"
+FRAME_TYPES = {"message", "read_receipt", "sync", "friends_update_request", "typing", "group_message", "group_read"}
+
+async def run_in_background(coro, label):
+    try:
+        await coro
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log("background_task.failed", task=label, error=str(e))
 
 @router.websocket("/ws/{phone_number}")
 async def websocket_endpoint(
     websocket: WebSocket,
     phone_number: str,
-    token: str = Query(None)
+    token: str = Query(None),
+    frame_codec: Optional[str] = Query(None, alias="codec")
 ):
      
     # JWT validation
@@ -69,20 +136,65 @@ async def websocket_endpoint(
             await websocket.close(code=1008)
             return
     except JWTError as e:
-        print(f"JWT error: {e}")
+        log("ws.auth_failed", sample_rate=LOG_SAMPLE_RATE, error=str(e))
         await websocket.close(code=1008)
         return
 
+    # Refuse new sockets while the event loop is already falling behind
+    if shed("ws_connect"):
+        await websocket.close(code=1013)
+        return
+    # Reconnect storms are limited per user; each socket then gets its own frame buckets
+    if await rest_limiter.check("connect", phone_number):
+        await websocket.close(code=1013)
+        return
+    limiter_key = f"{phone_number}:{uuid.uuid4().hex}"
+
     await websocket.accept()
-    set_user_online(phone_number)
-    active_connections[phone_number] = websocket
-    print(f"WebSocket accepted: {phone_number}")
-    
+    # "?codec=msgpack" switches this socket to binary frames when msgpack is installed
+    ws_codec = codec.get_codec(frame_codec)
+    # All frames to this socket go through its outbound queue
+    connection = await registry.register(phone_number, websocket, ws_codec)
+    background_tasks = set()
+    presence_connected = False
+    # Everything after register is inside the try, so a failure here still unregisters
     try:
+        user_doc = await get_user_by_phone(phone_number) or {}
+        await presence.connect(phone_number, user_doc.get("friends", []))
+        presence_connected = True
+        # Full summary on connect, deltas afterwards
+        summary_pushes.schedule(phone_number)
+        # Deliver what arrived while offline without holding up the receive loop
+        task = asyncio.create_task(run_in_background(
+            offline_sync.drain_pending(phone_number, connection), f"offline drain for {phone_number}"
+        ))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        log("ws.connected", sample_rate=LOG_SAMPLE_RATE, phone=phone_number)
+
         while True:
-            data = await websocket.receive_text()
-            
-            message_data = json.loads(data)
+            message_data = await codec.receive_frame(websocket, ws_codec)
+            # Any inbound frame counts as a heartbeat
+            presence.heartbeat(phone_number)
+            frame_type = message_data.get("type")
+            frame_type = frame_type if frame_type in FRAME_TYPES else "other"
+            frame_started = time.perf_counter()
+
+            if frame_type in SHEDDABLE_FRAMES and shed("ws_frame"):
+                if frame_type != "typing":
+                    connection.push({"type": "rate_limited", "frame_type": frame_type, "retry_after": 1, "reason": "overloaded"})
+                continue
+            retry_after = await frame_limiter.check(frame_type, limiter_key)
+            if retry_after:
+                # Typing is best-effort anyway; everything else tells the client when to retry
+                if frame_type != "typing":
+                    connection.push({
+                        "type": "rate_limited",
+                        "frame_type": frame_type,
+                        "retry_after": round(retry_after, 2),
+                        "client_temp_id": message_data.get("client_temp_id")
+                    })
+                continue
 
             # Handle different message types
             if message_data.get("type") == "message":
@@ -90,38 +202,28 @@ async def websocket_endpoint(
                 client_temp_id = message_data.get("client_temp_id")
                 message_id = f"{phone_number}_{receiver}_{datetime.now(timezone.utc).timestamp()}"
 
+                # Decide delivery up front so the message is written exactly once
+                receiver_online = await registry.is_connected(receiver)
+                now = datetime.now(timezone.utc).isoformat()
+
                 # Create message object
                 msg_obj = {
                     "_id": message_id,
                     "from": phone_number,
                     "to": receiver,
                     "message": message_data.get("message"),
-                    "time": datetime.now(timezone.utc).isoformat(),
-                    "status": "sent",  # Start with 'sent'
-                    "delivered_at": None,
+                    "time": now,
+                    "status": "delivered" if receiver_online else "sent",
+                    "delivered_at": now if receiver_online else None,
                     "read_at": None
                 }
-                
-             
-                chats_collection.insert_one(msg_obj)
-
-                # Send FCM notification
-                try:
-                    sender = db["users"].find_one({"phone_number": phone_number})
-                    send_fcm_notification(
-                        to_phone=receiver,
-                        sender_username=sender["username"] if sender else phone_number,
-                        message_text=message_data.get("message")
-                    )
-                except Exception as e:
-                    print(f"FCM notification error: {e}")
-
-                # Update unread count for receiver
-                chat_meta_collection.update_one(
-                    {"user": receiver, "friend": phone_number},
-                    {"$inc": {"unread": 1}},
-                    upsert=True
-                )
+
+                # Stores the message and updates the conversation record (last message, unread)
+                await conversations.message_writer.write(msg_obj)
+                typing_relay.clear(phone_number, receiver)
+
+                # Queue FCM notification (sent later only if the receiver is still offline)
+                notifier.enqueue(receiver, phone_number, message_data.get("message"))
 
                 # CRITICAL FIX: Always send delivery receipt to sender first
                
@@ -131,23 +233,9 @@ async def websocket_endpoint(
                     "status": "sent",
                     "client_temp_id": client_temp_id
                 }
-                await websocket.send_text(json.dumps(initial_receipt))
-
-                # Check if receiver is online
-                if receiver in active_connections:
-                    
-                    
-                    # Update message status to delivered in database
-                    chats_collection.update_one(
-                        {"_id": message_id},
-                        {
-                            "$set": {
-                                "status": "delivered",
-                                "delivered_at": datetime.now(timezone.utc).isoformat()
-                            }
-                        }
-                    )
-                    
+                connection.push(initial_receipt)
+
+                if receiver_online:
                     # Send message to receiver
                     receiver_message = {
                         "type": "message",
@@ -158,8 +246,12 @@ async def websocket_endpoint(
                         "time": msg_obj["time"],
                                              
                     }
-                    await active_connections[receiver].send_text(json.dumps(receiver_message))
-                    
+                    receiver_online = await registry.send(receiver, receiver_message)
+                    if not receiver_online:
+                        # Went offline (or was dropped) after the check; leave it for the offline drain
+                        await conversations.message_writer.mark_undelivered(msg_obj)
+
+                if receiver_online:
                     delivered_receipt = {
                         "type": "delivery_receipt",
                         "message_id": message_id,
@@ -167,7 +259,7 @@ async def websocket_endpoint(
                         "client_temp_id": client_temp_id
                     }
                      
-                    await websocket.send_text(json.dumps(delivered_receipt))
+                    connection.push(delivered_receipt)
                 else:
                     # Receiver is offline, send only "sent" receipt
                     sent_receipt = {
@@ -177,13 +269,27 @@ async def websocket_endpoint(
                         "client_temp_id": client_temp_id
                     }
                      
-                    await websocket.send_text(json.dumps(sent_receipt))
+                    connection.push(sent_receipt)
 
                 # Send unread updates to both users
-                await send_unread_update(phone_number)  # sender
-                await send_unread_update(receiver)      # receiver
+                summary_pushes.schedule(phone_number, [receiver])  # sender
+                summary_pushes.schedule(receiver, [phone_number])  # receiver
 
             # Handle read receipts
+            elif message_data.get("type") == "read_receipt" and message_data.get("up_to_time"):
+                # Range receipt: "read everything from sender up to this time"
+                sender_phone = message_data.get("sender")
+                up_to_time = message_data.get("up_to_time")
+                count = await conversations.mark_read_up_to(phone_number, sender_phone, up_to_time)
+                if count:
+                    await registry.send(sender_phone, {
+                        "type": "read_receipt_batch",
+                        "reader": phone_number,
+                        "up_to_time": up_to_time,
+                        "count": count,
+                        "status": "read"
+                    })
+
             elif message_data.get("type") == "read_receipt":
                 message_id = message_data.get("message_id")
                 sender_phone = message_data.get("sender")
@@ -191,7 +297,7 @@ async def websocket_endpoint(
                  
 
                 # Update message status to read in database
-                update_result = chats_collection.update_one(
+                update_result = await chats_collection.update_one(
                     {"_id": message_id, "from": sender_phone, "to": phone_number},
                     {
                         "$set": {
@@ -200,131 +306,143 @@ async def websocket_endpoint(
                         }
                     }
                 )
-                
-                
+                if update_result.modified_count:
+                    await conversations.decrement_unread(phone_number, sender_phone)
+                    await conversations.set_last_message_status(phone_number, sender_phone, message_id, "read")
 
                 # Send read receipt back to original sender if they're online
-                if sender_phone in active_connections:
-                    read_receipt_response = {
-                        "type": "read_receipt",
-                        "message_id": message_id,
-                        "status": "read"
-                    }
-                     
-                    await active_connections[sender_phone].send_text(json.dumps(read_receipt_response))
+                read_receipt_response = {
+                    "type": "read_receipt",
+                    "message_id": message_id,
+                    "status": "read"
+                }
+                await registry.send(sender_phone, read_receipt_response)
+
+            # One stored message, fanned out to the group's members
+            elif message_data.get("type") == "group_message":
+                await groups.send_group_message(
+                    phone_number,
+                    message_data.get("group_id"),
+                    message_data.get("message"),
+                    message_data.get("client_temp_id"),
+                    connection,
+                    notifier
+                )
+
+            # Group read cursor: everything up to `seq` is read
+            elif message_data.get("type") == "group_read":
+                group_id = message_data.get("group_id")
+                if await groups.mark_group_read(phone_number, group_id, message_data.get("seq")):
+                    summary_pushes.schedule(phone_number, [group_id])
+
+            # Client reconnected with its last-seen cursor
+            elif message_data.get("type") == "sync":
+                task = asyncio.create_task(run_in_background(
+                    offline_sync.sync_since(phone_number, message_data.get("cursor"), connection),
+                    f"sync for {phone_number}"
+                ))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+
+            # Client asks for the full summary again
+            elif message_data.get("type") == "friends_update_request":
+                summary_pushes.schedule(phone_number)
 
             # Handle typing indicators
             elif message_data.get("type") == "typing":
                 receiver = message_data.get("to")
                 is_typing = message_data.get("is_typing", False)
-   
-                if receiver in active_connections:
-                    typing_message = {
-                        "type": "typing",
-                        "from": phone_number,
-                        "to": receiver,
-                        "is_typing": is_typing
-                    }
-                    await active_connections[receiver].send_text(json.dumps(typing_message))
+                # Throttled, state-change-only forwarding; never persisted
+                await typing_relay.update(phone_number, receiver, bool(is_typing))
+
+            metrics.inc("ws_frames_in_total", type=frame_type)
+            metrics.observe("ws_frame_seconds", time.perf_counter() - frame_started, type=frame_type)
 
     except WebSocketDisconnect:
-        print(f"WebSocket disconnected: {phone_number}")
-        set_user_offline(phone_number)
-        if phone_number in active_connections:
-            del active_connections[phone_number]
+        log("ws.disconnected", sample_rate=LOG_SAMPLE_RATE, phone=phone_number)
     except Exception as e:
-        print(f"WebSocket error for {phone_number}: {e}")
-        if phone_number in active_connections:
-            del active_connections[phone_number]
+        log("ws.error", phone=phone_number, error=str(e))
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await registry.unregister(phone_number, connection)
+        await typing_relay.drop_sender(phone_number)
+        if presence_connected:
+            await presence.disconnect(phone_number)
 
 # Add a REST endpoint to fetch chat history
 @router.get("/history/{user1}/{user2}")
 async def get_chat_history(
     user1: str,
     user2: str,
+    response: Response,
     limit: int = Query(50, ge=1, le=100),
-    before: Optional[str] = None
+    before: Optional[str] = None,
+    after: Optional[str] = None
 ):
-    query = {
-        "$or": [
-            {"from": user1, "to": user2},
-            {"from": user2, "to": user1}
-        ]
-    }
+    before_pos = after_pos = None
     if before:
-        query["time"] = {"$lt": before}
-    
-    messages = list(
-        chats_collection.find(query)
-        .sort("time", -1)
-        .limit(limit)
+        # Opaque (time, _id) cursor; a bare ISO time is still accepted from older clients
+        before_pos = conversations.decode_cursor(before) or (before, "")
+    if after:
+        after_pos = conversations.decode_cursor(after)
+        if after_pos is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    messages = await retention.get_history_page(
+        conversations.conversation_id(user1, user2), limit, before=before_pos, after=after_pos
     )
-    messages.reverse()  # So the oldest is first
+    if messages:
+        # Page backwards with X-Before-Cursor, sync forwards on reconnect with X-After-Cursor
+        response.headers["X-Before-Cursor"] = conversations.encode_cursor(messages[0])
+        response.headers["X-After-Cursor"] = conversations.encode_cursor(messages[-1])
     return messages
 
+@router.get("/history/{user1}/{user2}/export")
+async def export_chat_history(user1: str, user2: str):
+    async def stream():
+        yield "["
+        first = True
+        async for msg in retention.iter_history(conversations.conversation_id(user1, user2)):
+            yield ("" if first else ",") + codec.dumps(msg)
+            first = False
+        yield "]"
+
+    return StreamingResponse(stream(), media_type="application/json")
+
 @router.post("/reset_unread/{user}/{friend}")
 async def reset_unread(user: str, friend: str):
+    # Everything the friend sent up to now is read; one range update, no documents loaded
+    up_to_time = datetime.now(timezone.utc).isoformat()
+    count = await conversations.mark_read_up_to(user, friend, up_to_time)
+
     # Reset unread count
-    chat_meta_collection.update_one(
-        {"user": user, "friend": friend},
-        {"$set": {"unread": 0}},
-        upsert=True
-    )
+    await conversations.reset_unread(user, friend)
 
-    # Get all unread messages from friend to user
-    unread_messages = list(chats_collection.find({
-        "from": friend,
-        "to": user,
-        "status": {"$in": ["sent", "delivered"]}  # Messages that haven't been read yet
-    }))
-
-    # Update all unread messages to read status
-    if unread_messages:
-        message_ids = [msg["_id"] for msg in unread_messages]
-        update_result = chats_collection.update_many(
-            {"_id": {"$in": message_ids}},
-            {
-                "$set": {
-                    "status": "read",
-                    "read_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
-        )
-        
-        # Send read receipts for all these messages if friend is online
-        if friend in active_connections:
-            for msg in unread_messages:
-                read_receipt = {
-                    "type": "read_receipt",
-                    "message_id": str(msg["_id"]),
-                    "status": "read"
-                }
-                await active_connections[friend].send_text(json.dumps(read_receipt))
-                
+    # One coalesced receipt instead of one frame per message
+    if count:
+        await registry.send(friend, {
+            "type": "read_receipt_batch",
+            "reader": user,
+            "up_to_time": up_to_time,
+            "count": count,
+            "status": "read"
+        })
 
     # Send unread updates to both users
-    await send_unread_update(user)
-    await send_unread_update(friend)
+    summary_pushes.schedule(user, [friend])
+    summary_pushes.schedule(friend, [user])
 
-    return {"message": f"Unread count reset, {len(unread_messages)} messages marked as read"}
+    return {"message": f"Unread count reset, {count} messages marked as read"}
 
 @router.delete("/delete_chat/{user}/{friend}")
 async def delete_chat(user: str, friend: str):
-    # Delete all chat messages between users
-    delete_result = chats_collection.delete_many({
-        "$or": [
-            {"from": user, "to": friend},
-            {"from": friend, "to": user}
-        ]
-    })
-    
-    # Delete chat metadata
-    chat_meta_collection.delete_many({
-        "$or": [
-            {"user": user, "friend": friend},
-            {"user": friend, "friend": user}
-        ]
-    })
+    # Tombstone hides every message so far at once; the retention worker deletes them in batches
+    await retention.delete_conversation_history(conversations.conversation_id(user, friend))
+    retention.retention_worker.wake()
+
+    # Delete the conversation record
+    await conversations.delete_conversation(user, friend)
     await send_friends_update(user)
     await send_friends_update(friend)
-    return {"message": f"Chat deleted, {delete_result.deleted_count} messages removed"}
\ No newline at end of file
+    return {"message": "Chat deleted"}
\ No newline at end of file
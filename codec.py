@@ -0,0 +1,86 @@
+import json
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import orjson
+except ImportError:  # falls back to the standard library
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # binary framing is simply not offered
+    msgpack = None
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, obj) -> str:
+        return dumps(obj)
+
+    def decode(self, data):
+        return loads(data)
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+JSON = JsonCodec()
+CODECS = {"json": JSON}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+def get_codec(name: str = None):
+    """Codec a client asked for at connect time; JSON when unknown or not installed."""
+    return CODECS.get(name or "json", JSON)
+
+class Frame:
+    """An outbound frame that is encoded at most once per codec, however many sockets it goes to."""
+
+    __slots__ = ("_obj", "_encoded")
+
+    def __init__(self, obj=None, encoded_json: str = None):
+        self._obj = obj
+        self._encoded = {}
+        if encoded_json is not None:
+            self._encoded["json"] = encoded_json
+
+    @property
+    def obj(self):
+        if self._obj is None:
+            self._obj = loads(self._encoded["json"])
+        return self._obj
+
+    def encode(self, codec=JSON):
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            encoded = self._encoded[codec.name] = codec.encode(self.obj)
+        return encoded
+
+def as_frame(frame) -> Frame:
+    return frame if isinstance(frame, Frame) else Frame(frame)
+
+async def receive_frame(websocket: WebSocket, codec=JSON):
+    """Next decoded frame from the client, whichever of text/binary it arrives as."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return codec.decode(message["bytes"]) if codec.binary else loads(message["bytes"])
+    return loads(message["text"])
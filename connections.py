@@ -0,0 +1,285 @@
+import os
+import json
+import uuid
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import WebSocket
+from codec import JSON, Frame, as_frame
+from metrics import metrics, log
+
+NODE_ID = os.getenv("NODE_ID") or uuid.uuid4().hex
+MESSAGE_BUS_URL = os.getenv("MESSAGE_BUS_URL")
+OUTBOUND_QUEUE_SIZE = int(os.getenv("WS_OUTBOUND_QUEUE_SIZE", "256"))
+OUTBOUND_SEND_TIMEOUT = float(os.getenv("WS_OUTBOUND_SEND_TIMEOUT", "10"))
+
+# handler(phone_number, json_text, ephemeral) delivers a frame to a socket held by this node
+DeliverHandler = Callable[[str, str, bool], Awaitable[None]]
+# listener(event) receives events broadcast by other nodes (e.g. cache invalidations)
+BroadcastHandler = Callable[[dict], Awaitable[None]]
+
+class Connection:
+    """A socket plus the bounded queue of frames waiting to be written to it by its own writer task.
+
+    When the queue is full, ephemeral frames (typing) are dropped first; if there is nothing
+    ephemeral left to drop, the client is too slow to keep up and gets disconnected.
+    """
+
+    def __init__(self, websocket: WebSocket, codec=JSON, max_size: int = OUTBOUND_QUEUE_SIZE, send_timeout: float = OUTBOUND_SEND_TIMEOUT):
+        self.websocket = websocket
+        self.codec = codec
+        self.max_size = max_size
+        self.send_timeout = send_timeout
+        self.frames = deque()
+        self.dropped = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def push(self, frame, ephemeral: bool = False) -> bool:
+        """Queue a frame (dict or Frame) without waiting on the socket; False if it was dropped."""
+        if self.closed:
+            return False
+        if len(self.frames) >= self.max_size:
+            if ephemeral:
+                self.dropped += 1
+                metrics.inc("ws_frames_dropped_total")
+                return False
+            for i, (_, queued_ephemeral) in enumerate(self.frames):
+                if queued_ephemeral:
+                    del self.frames[i]
+                    self.dropped += 1
+                    metrics.inc("ws_frames_dropped_total")
+                    break
+            else:
+                metrics.inc("ws_slow_consumer_disconnects_total")
+                log("ws.slow_consumer_disconnected", queued=len(self.frames))
+                self.close(code=1013)
+                return False
+        self.frames.append((as_frame(frame), ephemeral))
+        self._ready.set()
+        return True
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.frames:
+                    self._ready.clear()
+                    await self._ready.wait()
+                frame, _ = self.frames.popleft()
+                data = frame.encode(self.codec)
+                send = self.websocket.send_bytes if self.codec.binary else self.websocket.send_text
+                await asyncio.wait_for(send(data), self.send_timeout)
+                metrics.inc("ws_frames_out_total")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log("ws.writer_stopped", error=str(e))
+            self.close(code=1011)
+
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+class InMemoryBus:
+    """Bus for a single worker. Share one instance between registries to fake several nodes."""
+
+    def __init__(self):
+        self.locations: Dict[str, str] = {}
+        self.handlers: Dict[str, DeliverHandler] = {}
+        self.broadcast_handlers: Dict[str, BroadcastHandler] = {}
+
+    async def start(self, node_id: str, handler: DeliverHandler, on_broadcast: BroadcastHandler):
+        self.handlers[node_id] = handler
+        self.broadcast_handlers[node_id] = on_broadcast
+
+    async def stop(self, node_id: str):
+        self.handlers.pop(node_id, None)
+        self.broadcast_handlers.pop(node_id, None)
+
+    async def broadcast(self, node_id: str, event: dict):
+        for other_id, handler in list(self.broadcast_handlers.items()):
+            if other_id != node_id:
+                await handler(event)
+
+    async def set_location(self, phone: str, node_id: str):
+        self.locations[phone] = node_id
+
+    async def clear_location(self, phone: str, node_id: str):
+        if self.locations.get(phone) == node_id:
+            del self.locations[phone]
+
+    async def get_location(self, phone: str) -> Optional[str]:
+        node_id = self.locations.get(phone)
+        return node_id if node_id in self.handlers else None
+
+    async def publish(self, node_id: str, phone: str, text: str, ephemeral: bool = False) -> bool:
+        handler = self.handlers.get(node_id)
+        if handler is None:
+            return False
+        await handler(phone, text, ephemeral)
+        return True
+
+class RedisBus:
+    """Routes frames between workers with Redis pub/sub: one channel per node, one hash of phone -> node."""
+
+    def __init__(self, url: str, prefix: str = "chitchat", heartbeat: int = 10):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.heartbeat = heartbeat
+        self._pubsub = None
+        self._tasks = []
+
+    def _channel(self, node_id: str) -> str:
+        return f"{self.prefix}:node:{node_id}"
+
+    @property
+    def _broadcast_channel(self) -> str:
+        return f"{self.prefix}:broadcast"
+
+    def _alive_key(self, node_id: str) -> str:
+        return f"{self.prefix}:alive:{node_id}"
+
+    @property
+    def _locations_key(self) -> str:
+        return f"{self.prefix}:connections"
+
+    async def start(self, node_id: str, handler: DeliverHandler, on_broadcast: BroadcastHandler):
+        self._pubsub = self.redis.pubsub()
+        await self._pubsub.subscribe(self._channel(node_id), self._broadcast_channel)
+        self._tasks = [
+            asyncio.create_task(self._listen(node_id, handler, on_broadcast)),
+            asyncio.create_task(self._beat(node_id)),
+        ]
+
+    async def stop(self, node_id: str):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe()
+            await self._pubsub.close()
+        await self.redis.delete(self._alive_key(node_id))
+
+    async def _listen(self, node_id: str, handler: DeliverHandler, on_broadcast: BroadcastHandler):
+        async for msg in self._pubsub.listen():
+            if msg["type"] != "message":
+                continue
+            try:
+                data = json.loads(msg["data"])
+                if msg["channel"] == self._broadcast_channel:
+                    if data.get("origin") != node_id:
+                        await on_broadcast(data["event"])
+                    continue
+                await handler(data["to"], data["frame"], data.get("ephemeral", False))
+            except Exception as e:
+                log("bus.delivery_failed", error=str(e))
+
+    async def _beat(self, node_id: str):
+        # Locations pointing at a node whose alive key expired are ignored
+        while True:
+            await self.redis.set(self._alive_key(node_id), 1, ex=self.heartbeat * 3)
+            await asyncio.sleep(self.heartbeat)
+
+    async def set_location(self, phone: str, node_id: str):
+        await self.redis.hset(self._locations_key, phone, node_id)
+
+    async def clear_location(self, phone: str, node_id: str):
+        if await self.redis.hget(self._locations_key, phone) == node_id:
+            await self.redis.hdel(self._locations_key, phone)
+
+    async def get_location(self, phone: str) -> Optional[str]:
+        node_id = await self.redis.hget(self._locations_key, phone)
+        if node_id and await self.redis.exists(self._alive_key(node_id)):
+            return node_id
+        return None
+
+    async def publish(self, node_id: str, phone: str, text: str, ephemeral: bool = False) -> bool:
+        payload = json.dumps({"to": phone, "frame": text, "ephemeral": ephemeral})
+        receivers = await self.redis.publish(self._channel(node_id), payload)
+        return receivers > 0
+
+    async def broadcast(self, node_id: str, event: dict):
+        await self.redis.publish(self._broadcast_channel, json.dumps({"origin": node_id, "event": event}))
+
+class ConnectionRegistry:
+    """Sockets held by this worker, plus routing through the bus to sockets held elsewhere."""
+
+    def __init__(self, bus=None, node_id: str = NODE_ID):
+        self.bus = bus or InMemoryBus()
+        self.node_id = node_id
+        self.local: Dict[str, Connection] = {}
+        self.broadcast_listeners = []
+
+    async def start(self):
+        await self.bus.start(self.node_id, self._deliver_local, self._on_broadcast)
+
+    async def stop(self):
+        await self.bus.stop(self.node_id)
+
+    async def register(self, phone: str, websocket: WebSocket, codec=JSON) -> Connection:
+        connection = Connection(websocket, codec)
+        self.local[phone] = connection
+        await self.bus.set_location(phone, self.node_id)
+        return connection
+
+    async def unregister(self, phone: str, connection: Optional[Connection] = None):
+        current = self.local.get(phone)
+        # A newer socket for the same user may already have replaced this one
+        if connection is not None and current is not connection:
+            connection.close()
+            return
+        if current is not None:
+            current.close()
+        self.local.pop(phone, None)
+        await self.bus.clear_location(phone, self.node_id)
+
+    async def is_connected(self, phone: str) -> bool:
+        if phone in self.local:
+            return True
+        return await self.bus.get_location(phone) is not None
+
+    async def send(self, phone: str, frame, ephemeral: bool = False) -> bool:
+        """Queue a frame (dict or Frame) for the user's socket wherever it lives; False if they are not connected."""
+        connection = self.local.get(phone)
+        if connection is not None:
+            return connection.push(frame, ephemeral)
+        node_id = await self.bus.get_location(phone)
+        if node_id is None or node_id == self.node_id:
+            return False
+        return await self.bus.publish(node_id, phone, as_frame(frame).encode(JSON), ephemeral)
+
+    def add_broadcast_listener(self, listener: BroadcastHandler):
+        self.broadcast_listeners.append(listener)
+
+    async def broadcast(self, event: dict):
+        """Send an event to every other node; the caller has already applied it locally."""
+        await self.bus.broadcast(self.node_id, event)
+
+    async def _on_broadcast(self, event: dict):
+        for listener in self.broadcast_listeners:
+            try:
+                await listener(event)
+            except Exception as e:
+                log("bus.broadcast_listener_failed", error=str(e))
+
+    async def _deliver_local(self, phone: str, text: str, ephemeral: bool = False):
+        connection = self.local.get(phone)
+        if connection is not None:
+            connection.push(Frame(encoded_json=text), ephemeral)
+
+registry = ConnectionRegistry(bus=RedisBus(MESSAGE_BUS_URL) if MESSAGE_BUS_URL else InMemoryBus())
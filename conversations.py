@@ -0,0 +1,346 @@
+import os
+import json
+import base64
+import asyncio
+from datetime import datetime, timezone
+from pymongo import UpdateOne, ReplaceOne, DeleteOne
+from models import client, db, users_collection, chats_collection
+from metrics import log
+
+# One document per unordered pair, kept in step with `chats` on every write
+conversations_collection = db["conversations"]
+
+USE_TRANSACTIONS = os.getenv("MONGODB_TRANSACTIONS", "1") == "1"
+# "direct" writes each message as it arrives, "batched" group-commits them
+MESSAGE_WRITE_MODE = os.getenv("MESSAGE_WRITE_MODE", "direct")
+# "durable" acks the sender after the write, "buffered" as soon as the message is queued
+MESSAGE_ACK_MODE = os.getenv("MESSAGE_ACK_MODE", "durable")
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "5")) / 1000
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "500"))
+UNREAD_STATUSES = ["sent", "delivered"]
+# Only the fields the chat screen renders
+HISTORY_PROJECTION = {"_id": 1, "from": 1, "to": 1, "message": 1, "time": 1, "status": 1}
+
+def conversation_id(user1: str, user2: str) -> str:
+    a, b = sorted((user1, user2))
+    return f"{a}_{b}"
+
+def _conversation_updates(messages: list) -> list:
+    """One upsert per conversation: the newest message wins, unread increments are summed."""
+    latest = {}
+    unread = {}
+    for msg_obj in messages:
+        cid = msg_obj["conversation_id"]
+        latest[cid] = msg_obj
+        unread.setdefault(cid, {})
+        unread[cid][msg_obj["to"]] = unread[cid].get(msg_obj["to"], 0) + 1
+    updates = []
+    for cid, msg_obj in latest.items():
+        updates.append(UpdateOne(
+            {"_id": cid},
+            {
+                "$set": {
+                    "members": sorted((msg_obj["from"], msg_obj["to"])),
+                    "last_message": msg_obj["message"],
+                    "last_message_time": msg_obj["time"],
+                    "last_message_status": msg_obj["status"],
+                    "last_message_id": msg_obj["_id"],
+                    "last_message_from": msg_obj["from"],
+                },
+                "$inc": {f"unread.{receiver}": count for receiver, count in unread[cid].items()},
+            },
+            upsert=True
+        ))
+    return updates
+
+async def _write_messages(messages: list):
+    updates = _conversation_updates(messages)
+    if not USE_TRANSACTIONS:
+        await chats_collection.insert_many(messages, ordered=False)
+        await conversations_collection.bulk_write(updates, ordered=False)
+        return
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            await chats_collection.insert_many(messages, ordered=False, session=session)
+            await conversations_collection.bulk_write(updates, ordered=False, session=session)
+
+async def record_message(msg_obj: dict):
+    """Insert a message and bump its conversation record in the same transaction."""
+    msg_obj["conversation_id"] = conversation_id(msg_obj["from"], msg_obj["to"])
+    await _write_messages([msg_obj])
+
+class MessageWriter:
+    """Group-commits messages: buffers them for a few ms and writes each batch with one insert_many
+    plus one bulk_write of conversation updates."""
+
+    def __init__(
+        self,
+        batched: bool = MESSAGE_WRITE_MODE == "batched",
+        ack_after_buffer: bool = MESSAGE_ACK_MODE == "buffered",
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+    ):
+        self.batched = batched
+        self.ack_after_buffer = ack_after_buffer
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    async def write(self, msg_obj: dict):
+        if not self.batched:
+            await record_message(msg_obj)
+            return
+        msg_obj["conversation_id"] = conversation_id(msg_obj["from"], msg_obj["to"])
+        future = asyncio.get_running_loop().create_future()
+        self.buffer.append((msg_obj, future))
+        if len(self.buffer) >= self.batch_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._schedule_flush)
+        if not self.ack_after_buffer:
+            await future
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # Batches are written one at a time so conversation records never move backwards
+        async with self._lock:
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+            try:
+                await _write_messages([msg_obj for msg_obj, _ in batch])
+            except Exception as e:
+                log("messages.batch_write_failed", messages=len(batch), error=str(e))
+                for _, future in batch:
+                    if not self.ack_after_buffer and not future.done():
+                        future.set_exception(e)
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def mark_undelivered(self, msg_obj: dict):
+        """Put a message back to "sent" after the push to its receiver failed, so the offline drain picks it up."""
+        # Still buffered: it gets written as "sent"
+        msg_obj["status"] = "sent"
+        msg_obj["delivered_at"] = None
+        # Already written, or being written right now: wait for that batch, then undo it
+        async with self._lock:
+            result = await chats_collection.update_one(
+                {"_id": msg_obj["_id"], "status": "delivered"},
+                {"$set": {"status": "sent", "delivered_at": None}}
+            )
+        if result.modified_count:
+            await conversations_collection.update_one(
+                {
+                    "_id": conversation_id(msg_obj["from"], msg_obj["to"]),
+                    "last_message_id": msg_obj["_id"],
+                    "last_message_status": "delivered",
+                },
+                {"$set": {"last_message_status": "sent"}}
+            )
+
+    async def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+message_writer = MessageWriter()
+
+async def set_last_message_status(user1: str, user2: str, message_id: str, status: str):
+    # Only touches the record if the message is still the latest one
+    await conversations_collection.update_one(
+        {"_id": conversation_id(user1, user2), "last_message_id": message_id},
+        {"$set": {"last_message_status": status}}
+    )
+
+async def decrement_unread(user: str, friend: str):
+    await conversations_collection.update_one(
+        {"_id": conversation_id(user, friend), f"unread.{user}": {"$gt": 0}},
+        {"$inc": {f"unread.{user}": -1}}
+    )
+
+async def mark_read_up_to(reader: str, sender: str, up_to_time: str) -> int:
+    """Mark everything `sender` sent to `reader` up to `up_to_time` as read with one update_many."""
+    now = datetime.now(timezone.utc).isoformat()
+    result = await chats_collection.update_many(
+        {
+            "to": reader,
+            "from": sender,
+            "status": {"$in": UNREAD_STATUSES},
+            "time": {"$lte": up_to_time},
+        },
+        {"$set": {"status": "read", "read_at": now}}
+    )
+    if result.modified_count:
+        cid = conversation_id(reader, sender)
+        # `reader` can come from a URL; $literal keeps a "$..." value from being evaluated
+        await conversations_collection.update_one(
+            {"_id": cid},
+            [{"$set": {"unread": {"$mergeObjects": ["$unread", {"$arrayToObject": [[{
+                "k": {"$literal": reader},
+                "v": {"$max": [0, {"$subtract": [
+                    {"$ifNull": [{"$getField": {"field": {"$literal": reader}, "input": "$unread"}}, 0]},
+                    result.modified_count
+                ]}]}
+            }]]}]}}}]
+        )
+        await conversations_collection.update_one(
+            {"_id": cid, "last_message_from": sender, "last_message_time": {"$lte": up_to_time}},
+            {"$set": {"last_message_status": "read"}}
+        )
+    return result.modified_count
+
+async def reset_unread(user: str, friend: str):
+    cid = conversation_id(user, friend)
+    await conversations_collection.update_one(
+        {"_id": cid},
+        {"$set": {f"unread.{user}": 0, "members": sorted((user, friend))}},
+        upsert=True
+    )
+    # The friend's last message is now read as well
+    await conversations_collection.update_one(
+        {"_id": cid, "last_message_from": friend},
+        {"$set": {"last_message_status": "read"}}
+    )
+
+async def delete_conversation(user: str, friend: str):
+    await conversations_collection.delete_one({"_id": conversation_id(user, friend)})
+
+async def get_friends_summary(user_phone: str, friends: list, with_profiles: bool = False) -> dict:
+    """Last message, unread count and (optionally) profile for every friend via point reads."""
+    summary = {
+        friend: {
+            "unread": 0,
+            "last_message": "",
+            "last_message_time": "",
+            "last_message_status": "",
+        } for friend in friends
+    }
+    if not friends:
+        return summary
+
+    ids = {conversation_id(user_phone, friend): friend for friend in friends}
+    async for conv in conversations_collection.find({"_id": {"$in": list(ids)}}):
+        entry = summary[ids[conv["_id"]]]
+        entry["unread"] = conv.get("unread", {}).get(user_phone, 0)
+        entry["last_message"] = conv.get("last_message", "")
+        entry["last_message_time"] = conv.get("last_message_time", "")
+        entry["last_message_status"] = conv.get("last_message_status", "")
+
+    if with_profiles:
+        profiles = {}
+        async for u in users_collection.find(
+            {"phone_number": {"$in": friends}},
+            {"_id": 0, "phone_number": 1, "username": 1, "profile_image_url": 1, "profile_image_small_url": 1, "bio": 1, "email": 1}
+        ):
+            profiles[u["phone_number"]] = u
+        for friend, entry in summary.items():
+            friend_user = profiles.get(friend, {})
+            entry["username"] = friend_user.get("username", "")
+            entry["profile_image_url"] = friend_user.get("profile_image_url", "")
+            entry["profile_image_small_url"] = friend_user.get("profile_image_small_url", "")
+            entry["bio"] = friend_user.get("bio", "")
+            entry["email"] = friend_user.get("email", "")
+    return summary
+
+def encode_cursor(msg: dict) -> str:
+    raw = json.dumps([msg["time"], str(msg["_id"])], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Return (time, _id) for an opaque cursor, or None if it is not one."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        time, message_id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(time, str) or not isinstance(message_id, str):
+        return None
+    return time, message_id
+
+def _cursor_filter(position, op: str) -> dict:
+    time, message_id = position
+    return {"$or": [
+        {"time": {op: time}},
+        {"time": time, "_id": {op: message_id}}
+    ]}
+
+async def get_conversation_page(cid: str, limit: int, before=None, after=None, projection: dict = HISTORY_PROJECTION, floor: str = None) -> list:
+    """One page of messages, oldest first, strictly before/after a (time, _id) position and newer than `floor`."""
+    query = {"conversation_id": cid}
+    if floor:
+        query["time"] = {"$gt": floor}
+    if after is not None:
+        query.update(_cursor_filter(after, "$gt"))
+        direction = 1
+    else:
+        if before is not None:
+            query.update(_cursor_filter(before, "$lt"))
+        direction = -1
+    messages = await (
+        chats_collection.find(query, projection)
+        .sort([("time", direction), ("_id", direction)])
+        .limit(limit)
+        .to_list(length=limit)
+    )
+    if direction == -1:
+        messages.reverse()  # So the oldest is first
+    return messages
+
+async def rebuild_conversations(batch_size: int = 500) -> int:
+    """Recompute every conversation record from the messages in `chats` that haven't been deleted."""
+    pipeline = [
+        # Group messages keep their state on the group record itself
+        {"$match": {"group_id": {"$exists": False}}},
+        # Messages at or before a tombstone stay in `chats` until purged, but must not bring the chat back
+        {"$lookup": {"from": "tombstones", "localField": "conversation_id", "foreignField": "_id", "as": "tombstone"}},
+        {"$match": {"$expr": {"$or": [
+            {"$eq": [{"$size": "$tombstone"}, 0]},
+            {"$gt": ["$time", {"$arrayElemAt": ["$tombstone.before", 0]}]},
+        ]}}},
+        {"$sort": {"time": 1}},
+        {"$group": {
+            "_id": {"from": "$from", "to": "$to"},
+            "last": {"$last": "$$ROOT"},
+            "unread": {"$sum": {"$cond": [{"$in": ["$status", UNREAD_STATUSES]}, 1, 0]}},
+        }},
+    ]
+    conversations = {}
+    async for row in chats_collection.aggregate(pipeline, allowDiskUse=True):
+        sender, receiver = row["_id"]["from"], row["_id"]["to"]
+        if not sender or not receiver:
+            continue
+        last = row["last"]
+        cid = conversation_id(sender, receiver)
+        conv = conversations.setdefault(cid, {
+            "_id": cid,
+            "members": sorted((sender, receiver)),
+            "last_message_time": "",
+            "unread": {},
+        })
+        conv["unread"][receiver] = row["unread"]
+        if last.get("time", "") > conv["last_message_time"]:
+            conv.update({
+                "last_message": last.get("message"),
+                "last_message_time": last.get("time", ""),
+                "last_message_status": last.get("status"),
+                "last_message_id": last["_id"],
+                "last_message_from": sender,
+            })
+
+    ops = [ReplaceOne({"_id": cid}, conv, upsert=True) for cid, conv in conversations.items()]
+    # Deleted chats with nothing sent since have no record; drop any an earlier rebuild brought back
+    emptied = [t["_id"] async for t in db["tombstones"].find({}, {"_id": 1}) if t["_id"] not in conversations]
+    ops += [DeleteOne({"_id": cid, "type": {"$ne": "group"}}) for cid in emptied]
+    for i in range(0, len(ops), batch_size):
+        await conversations_collection.bulk_write(ops[i:i + batch_size], ordered=False)
+    return len(ops)
@@ -1,23 +1,18 @@
-import firebase_admin
 from firebase_admin import messaging
-from models import db
-from firebase_utils import cred
+from starlette.concurrency import run_in_threadpool
+from firebase_utils import get_firebase_app
+from metrics import metrics, log, LOG_SAMPLE_RATE
 
-# Only initialize if not already initialized
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
-
-def send_fcm_notification(to_phone, sender_username, message_text):
-    user = db["users"].find_one({"phone_number": to_phone})
-    if not user or "fcm_token" not in user:
-        print("No FCM token for user", to_phone)
-        return
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=f"New message from {sender_username}",
-            body=message_text,
-        ),
-        token=user["fcm_token"],
-    )
-    response = messaging.send(message)
-    print("Sent FCM notification:", response)
\ No newline at end of file
+class FirebaseMessagingBackend:
+    async def send_batch(self, notifications):
+        messages = [
+            messaging.Message(
+                notification=messaging.Notification(title=n["title"], body=n["body"]),
+                token=n["token"],
+            ) for n in notifications
+        ]
+        app = await run_in_threadpool(get_firebase_app)
+        response = await run_in_threadpool(messaging.send_each, messages, app=app)
+        metrics.inc("fcm_sent_total", response.success_count)
+        metrics.inc("fcm_failed_total", response.failure_count)
+        log("fcm.batch_sent", sample_rate=LOG_SAMPLE_RATE, ok=response.success_count, failed=response.failure_count)
@@ -1,29 +1,33 @@
 import firebase_admin
 from firebase_admin import credentials, storage
-import uuid
 import os
-import json
+import threading
 
-# Write the JSON string from environment to a temp file
 cred_path = "/tmp/firebase_admin_sdk.json"
-firebase_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
+_init_lock = threading.Lock()
 
-# Create the file only if it doesn't already exist
-if firebase_json and not os.path.exists(cred_path):
-    with open(cred_path, "w") as f:
-        f.write(firebase_json)
+def get_firebase_app():
+    """Initialize Firebase on first use instead of at import, so workers boot without touching it."""
+    with _init_lock:
+        if firebase_admin._apps:
+            return firebase_admin.get_app()
+        return _initialize()
 
-# Initialize Firebase app
-cred = credentials.Certificate(cred_path)
-
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred, {
+def _initialize():
+    # Write the JSON string from environment to a temp file
+    firebase_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
+    # Create the file only if it doesn't already exist
+    if firebase_json and not os.path.exists(cred_path):
+        with open(cred_path, "w") as f:
+            f.write(firebase_json)
+    cred = credentials.Certificate(cred_path)
+    return firebase_admin.initialize_app(cred, {
         "storageBucket": os.getenv("FIREBASE_STORAGE_BUCKET")
     })
 
-def upload_image_to_firebase(file_data: bytes, file_extension: str) -> str:
-    bucket = storage.bucket()
-    blob = bucket.blob(f"profile_images/{uuid.uuid4()}.{file_extension}")
-    blob.upload_from_string(file_data, content_type=f"image/{file_extension}")
+def upload_file_to_firebase(fileobj, path: str, content_type: str) -> str:
+    bucket = storage.bucket(app=get_firebase_app())
+    blob = bucket.blob(path)
+    blob.upload_from_file(fileobj, content_type=content_type)
     blob.make_public()
     return blob.public_url
@@ -1,10 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException
-from models import get_current_user, db
+import re
+import json
+import base64
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, ORJSONResponse
+from models import get_current_user, get_user_by_phone, db
+from cache import invalidate_user
 from schema import UserResponse
 
 # --- Add these imports ---
-import json
-from chat import active_connections  # Import your active_connections from chat.py
+from connections import registry  # Routes frames to the worker holding each socket
+import codec
+from metrics import log, LOG_SAMPLE_RATE
 
 router = APIRouter()
 
@@ -16,27 +23,26 @@ def ensure_user_fields(user):
     user.setdefault("email", "")
     user.setdefault("bio", "")
     user.setdefault("profile_image_url", "")
+    user.setdefault("profile_image_small_url", "")
+    user.setdefault("profile_image_medium_url", "")
     return user
 
 async def send_friends_update(phone_number):
-    print(f"send_friends_update called for {phone_number}")
-    if phone_number in active_connections:
-        print(f"Sending friends update to {phone_number} (connection found)")
-        await active_connections[phone_number].send_text(json.dumps({
-            "type": "friends_update_trigger"
-        }))
-    else:
-        print(f"No active connection for {phone_number}")
-        
+    sent = await registry.send(phone_number, {
+        "type": "friends_update_trigger"
+    })
+    log("friends.update_pushed", sample_rate=LOG_SAMPLE_RATE, phone=phone_number, connected=sent)
 
 # --- WebSocket push for pending requests ---
 async def send_pending_requests_update(phone_number):
-    print(f"send_pending_requests_update called for {phone_number}")
-    user_doc = users_collection.find_one({"phone_number": phone_number})
+    if not await registry.is_connected(phone_number):
+        log("friends.pending_update_skipped", sample_rate=LOG_SAMPLE_RATE, phone=phone_number, reason="not_connected")
+        return
+    user_doc = await get_user_by_phone(phone_number)
     if not user_doc:
-        print(f"No user doc found for {phone_number}")
+        log("friends.pending_update_skipped", phone=phone_number, reason="no_user")
         return
-    pending_requests = list(friend_requests_collection.find({"to": phone_number, "status": "pending"}))
+    pending_requests = await friend_requests_collection.find({"to": phone_number, "status": "pending"}).to_list(length=None)
     summary = {
         "pending_count": len(pending_requests),
         "pending_requests": [
@@ -46,22 +52,94 @@ async def send_pending_requests_update(phone_number):
             } for req in pending_requests
         ]
     }
-    if phone_number in active_connections:
-        print(f"Sending pending requests update to {phone_number} (connection found)")
-        await active_connections[phone_number].send_text(json.dumps({
-            "type": "pending_requests_update",
-            "summary": summary
-        }))
+    log("friends.pending_update_pushed", sample_rate=LOG_SAMPLE_RATE, phone=phone_number, pending=len(pending_requests))
+    await registry.send(phone_number, {
+        "type": "pending_requests_update",
+        "summary": summary
+    })
+
+# Exactly the UserResponse fields, so the documents can be returned without re-validation
+USER_RESPONSE_PROJECTION = {
+    "phone_number": 1, "username": 1, "email": 1, "bio": 1, "profile_image_url": 1,
+    "profile_image_small_url": 1, "profile_image_medium_url": 1, "friends": 1
+}
+
+DIRECTORY_PROJECTION = {"_id": 0, "phone_number": 1, "username": 1, "profile_image_url": 1, "profile_image_small_url": 1, "bio": 1}
+DIRECTORY_PAGE_SIZE = 50
+DIRECTORY_MAX_PAGE_SIZE = 200
+
+def encode_directory_cursor(key: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+def decode_directory_cursor(cursor: str) -> list:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or not all(isinstance(k, str) for k in key):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+async def search_directory(my_phone: str, q: Optional[str], limit: int, cursor: Optional[str], projection: dict):
+    """One page of other users, optionally filtered by username or phone prefix.
+
+    Phone searches walk the phone_number index; everything else walks (username_lower, phone_number).
+    Returns (users, next_cursor).
+    """
+    q = (q or "").strip()
+    digits = q.replace(" ", "").replace("-", "")
+    by_phone = bool(digits) and digits.lstrip("+").isdigit()
+    query = {"phone_number": {"$ne": my_phone}}
+    if by_phone:
+        # Numbers are stored as +91XXXXXXXXXX (see RegisterRequest.validate_phone)
+        if not digits.startswith("+"):
+            digits = "+91" + digits
+        query["phone_number"]["$regex"] = "^" + re.escape(digits)
+        sort = [("phone_number", 1)]
     else:
-        print(f"No active connection for {phone_number}")
+        if q:
+            query["username_lower"] = {"$regex": "^" + re.escape(q.lower())}
+        sort = [("username_lower", 1), ("phone_number", 1)]
+
+    if cursor:
+        key = decode_directory_cursor(cursor)
+        if by_phone:
+            query["phone_number"]["$gt"] = key[-1]
+        else:
+            after = {"$or": [
+                {"username_lower": {"$gt": key[0]}},
+                {"username_lower": key[0], "phone_number": {"$gt": key[-1]}}
+            ]}
+            query = {"$and": [query, after]}
+
+    users = await users_collection.find(
+        query, {**projection, "username_lower": 1}
+    ).sort(sort).limit(limit + 1).to_list(length=limit + 1)
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        last = users[-1]
+        key = [last["phone_number"]] if by_phone else [last.get("username_lower", ""), last["phone_number"]]
+        next_cursor = encode_directory_cursor(key)
+    for u in users:
+        u.pop("username_lower", None)
+    return users, next_cursor
 
 @router.get("/all_users/", response_model=list[UserResponse])
-async def get_all_users(user: dict = Depends(get_current_user)):
-    users = list(users_collection.find({"phone_number": {"$ne": user["phone_number"]}}))
+async def get_all_users(
+    user: dict = Depends(get_current_user),
+    q: Optional[str] = None,
+    limit: int = Query(DIRECTORY_PAGE_SIZE, ge=1, le=DIRECTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    users, next_cursor = await search_directory(user["phone_number"], q, limit, cursor, USER_RESPONSE_PROJECTION)
     for u in users:
         u["_id"] = str(u["_id"])
         ensure_user_fields(u)
-    return users
+        u.setdefault("friends", [])
+    response_class = ORJSONResponse if codec.orjson is not None else JSONResponse
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return response_class(users, headers=headers)
 
 @router.post("/send_request/{to_phone}/")
 async def send_friend_request(to_phone: str, user: dict = Depends(get_current_user)):
@@ -69,10 +147,10 @@ async def send_friend_request(to_phone: str, user: dict = Depends(get_current_us
     if from_phone == to_phone:
         raise HTTPException(status_code=400, detail="Cannot send request to yourself.")
     # Check if already sent
-    if friend_requests_collection.find_one({"from": from_phone, "to": to_phone, "status": "pending"}):
+    if await friend_requests_collection.find_one({"from": from_phone, "to": to_phone, "status": "pending"}):
         raise HTTPException(status_code=400, detail="Request already sent.")
     # Save the request
-    friend_requests_collection.insert_one({
+    await friend_requests_collection.insert_one({
         "from": from_phone,
         "to": to_phone,
         "status": "pending"
@@ -84,7 +162,7 @@ async def send_friend_request(to_phone: str, user: dict = Depends(get_current_us
 # Get pending requests for the current user
 @router.get("/pending_requests/")
 async def get_pending_requests(user: dict = Depends(get_current_user)):
-    requests = list(friend_requests_collection.find({"to": user["phone_number"], "status": "pending"}))
+    requests = await friend_requests_collection.find({"to": user["phone_number"], "status": "pending"}).to_list(length=None)
     for r in requests:
         r["_id"] = str(r["_id"])
     return requests
@@ -93,15 +171,16 @@ async def get_pending_requests(user: dict = Depends(get_current_user)):
 @router.post("/accept_request/{from_phone}/")
 async def accept_friend_request(from_phone: str, user: dict = Depends(get_current_user)):
     to_phone = user["phone_number"]
-    req = friend_requests_collection.find_one_and_update(
+    req = await friend_requests_collection.find_one_and_update(
         {"from": from_phone, "to": to_phone, "status": "pending"},
         {"$set": {"status": "accepted"}}
     )
     if not req:
         raise HTTPException(status_code=404, detail="Request not found")
     # Add each user to the other's friends list
-    users_collection.update_one({"phone_number": from_phone}, {"$addToSet": {"friends": to_phone}})
-    users_collection.update_one({"phone_number": to_phone}, {"$addToSet": {"friends": from_phone}})
+    await users_collection.update_one({"phone_number": from_phone}, {"$addToSet": {"friends": to_phone}})
+    await users_collection.update_one({"phone_number": to_phone}, {"$addToSet": {"friends": from_phone}})
+    await invalidate_user(from_phone, to_phone)
     # --- Push update to both users ---
     await send_pending_requests_update(to_phone)
     await send_pending_requests_update(from_phone)
@@ -113,16 +192,17 @@ async def accept_friend_request(from_phone: str, user: dict = Depends(get_curren
 @router.post("/unfriend/{friend_phone}/")
 async def unfriend(friend_phone: str, user: dict = Depends(get_current_user)):
     my_phone = user["phone_number"]
-    print(f"Unfriending: {my_phone} <-> {friend_phone}")
-    result1 = users_collection.update_one(
+    result1 = await users_collection.update_one(
         {"phone_number": my_phone},
         {"$pull": {"friends": friend_phone}}
     )
-    result2 = users_collection.update_one(
+    result2 = await users_collection.update_one(
         {"phone_number": friend_phone},
         {"$pull": {"friends": my_phone}}
     )
-    print(f"Update results: {result1.modified_count}, {result2.modified_count}")
+    log("friends.unfriended", phone=my_phone, friend=friend_phone,
+        modified=result1.modified_count + result2.modified_count)
+    await invalidate_user(my_phone, friend_phone)
     # --- Optionally push update if you want to update requests/friends in UI ---
     await send_pending_requests_update(my_phone)
     await send_pending_requests_update(friend_phone)
@@ -132,23 +212,38 @@ async def unfriend(friend_phone: str, user: dict = Depends(get_current_user)):
     return {"message": "Unfriended"}
 
 @router.get("/all_users_and_friends/")
-async def all_users_and_friends(user: dict = Depends(get_current_user)):
+async def all_users_and_friends(
+    user: dict = Depends(get_current_user),
+    q: Optional[str] = None,
+    limit: int = Query(DIRECTORY_PAGE_SIZE, ge=1, le=DIRECTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
     my_phone = user["phone_number"]
-    all_users = list(users_collection.find({"phone_number": {"$ne": my_phone}}))
+    all_users, next_cursor = await search_directory(my_phone, q, limit, cursor, DIRECTORY_PROJECTION)
     friends = user.get("friends", [])
-    pending_requests = list(friend_requests_collection.find({"to": my_phone, "status": "pending"}))
-    # Build pending_requests with user info
+    pending_requests = await friend_requests_collection.find(
+        {"to": my_phone, "status": "pending"}, {"_id": 0, "from": 1}
+    ).to_list(length=None)
+    # Build pending_requests with user info, all senders in one lookup
+    senders = {}
+    async for u in users_collection.find(
+        {"phone_number": {"$in": [req["from"] for req in pending_requests]}}, DIRECTORY_PROJECTION
+    ):
+        senders[u["phone_number"]] = u
     pending_requests_with_user = []
     for req in pending_requests:
-        from_user = users_collection.find_one({"phone_number": req["from"]}) or {}
+        from_user = senders.get(req["from"], {})
         pending_requests_with_user.append({
             "phone_number": req["from"],
             "username": from_user.get("username", ""),
             "bio": from_user.get("bio", ""),
             "profile_image_url": from_user.get("profile_image_url", ""),
+            "profile_image_small_url": from_user.get("profile_image_small_url", ""),
         })
   
-    sent_requests = list(friend_requests_collection.find({"from": my_phone, "status": "pending"}))
+    sent_requests = await friend_requests_collection.find(
+        {"from": my_phone, "status": "pending"}, {"_id": 0, "to": 1}
+    ).to_list(length=None)
     sent_requests_phones = [req["to"] for req in sent_requests]
     
     return {
@@ -157,10 +252,12 @@ async def all_users_and_friends(user: dict = Depends(get_current_user)):
                 "phone_number": u["phone_number"],
                 "username": u.get("username", ""),
                 "profile_image_url": u.get("profile_image_url", ""),
+                "profile_image_small_url": u.get("profile_image_small_url", ""),
                 "bio": u.get("bio", ""),
             } for u in all_users
         ],
         "friends": friends,
         "pending_requests": pending_requests_with_user,
         "sent_requests": sent_requests_phones,  
+        "next_cursor": next_cursor,
     }
\ No newline at end of file
@@ -0,0 +1,256 @@
+import os
+import uuid
+import asyncio
+from datetime import datetime, timezone
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from pydantic import BaseModel
+from pymongo import ReturnDocument
+from models import get_current_user, users_collection, chats_collection
+from conversations import conversations_collection, encode_cursor, decode_cursor
+from retention import get_history_page
+from connections import Connection, registry
+from codec import Frame
+
+GROUP_MAX_MEMBERS = int(os.getenv("GROUP_MAX_MEMBERS", "512"))
+GROUP_HISTORY_PROJECTION = {"_id": 1, "group_id": 1, "from": 1, "message": 1, "time": 1, "seq": 1}
+
+router = APIRouter()
+
+# A group is a conversation record with type "group". Every message bumps its `seq`;
+# each member's read cursor is read_seq.<phone>, so unread = seq - read_seq and
+# sending a message never writes anything per member.
+
+class GroupCreateRequest(BaseModel):
+    name: str
+    members: List[str]
+
+class GroupMembersRequest(BaseModel):
+    members: List[str]
+
+def is_group_id(value: str) -> bool:
+    return value.startswith("group_")
+
+def _summary_entry(group: dict, phone: str) -> dict:
+    seq = group.get("seq", 0)
+    return {
+        "group_id": group["_id"],
+        "name": group.get("name", ""),
+        "member_count": group.get("member_count", 0),
+        "seq": seq,
+        "unread": max(0, seq - group.get("read_seq", {}).get(phone, 0)),
+        "last_message": group.get("last_message", ""),
+        "last_message_time": group.get("last_message_time", ""),
+        "last_message_from": group.get("last_message_from", ""),
+    }
+
+async def get_groups_summary(phone: str, group_ids: Optional[list] = None) -> dict:
+    """Unread count and last message for the user's groups (or just `group_ids`), without loading member lists."""
+    query = {"members": phone, "type": "group"}
+    if group_ids is not None:
+        query["_id"] = {"$in": group_ids}
+    projection = {
+        "name": 1, "member_count": 1, "seq": 1, "last_message": 1, "last_message_time": 1,
+        "last_message_from": 1, f"read_seq.{phone}": 1
+    }
+    return {
+        group["_id"]: _summary_entry(group, phone)
+        async for group in conversations_collection.find(query, projection)
+    }
+
+async def _notify_members(members: list, frame: dict):
+    frame = Frame(frame)
+    await asyncio.gather(*(registry.send(member, frame) for member in members))
+
+async def send_group_message(sender: str, group_id: str, text: str, client_temp_id, connection: Connection, notifier):
+    """Store one message, push it once-encoded to online members and queue pushes for the rest."""
+    if not isinstance(text, str) or not isinstance(group_id, str):
+        connection.push({"type": "group_error", "group_id": group_id, "client_temp_id": client_temp_id, "detail": "Invalid message"})
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    # One write: bump seq, move the sender's read cursor to it and set the last message.
+    # Client values are $literal so a "$..." string isn't evaluated as an expression.
+    group = await conversations_collection.find_one_and_update(
+        {"_id": group_id, "type": "group", "members": sender},
+        [
+            {"$set": {"seq": {"$add": [{"$ifNull": ["$seq", 0]}, 1]}}},
+            {"$set": {
+                f"read_seq.{sender}": "$seq",
+                "last_message": {"$literal": text},
+                "last_message_time": now,
+                "last_message_from": {"$literal": sender},
+                "last_message_id": {"$concat": [{"$literal": group_id}, "_", {"$toString": "$seq"}]},
+            }},
+        ],
+        projection={"members": 1, "seq": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if group is None:
+        connection.push({"type": "group_error", "group_id": group_id, "client_temp_id": client_temp_id, "detail": "Not a member"})
+        return
+    seq = group["seq"]
+    message_id = f"{group_id}_{seq}"
+    await chats_collection.insert_one({
+        "_id": message_id,
+        "conversation_id": group_id,
+        "group_id": group_id,
+        "from": sender,
+        "message": text,
+        "time": now,
+        "seq": seq,
+    })
+    connection.push({
+        "type": "delivery_receipt",
+        "message_id": message_id,
+        "status": "sent",
+        "client_temp_id": client_temp_id,
+        "group_id": group_id,
+        "seq": seq,
+    })
+
+    recipients = [member for member in group["members"] if member != sender]
+    frame = Frame({
+        "type": "group_message",
+        "group_id": group_id,
+        "from": sender,
+        "message": text,
+        "message_id": message_id,
+        "seq": seq,
+        "time": now,
+    })
+    delivered = await asyncio.gather(*(registry.send(member, frame) for member in recipients))
+    # Offline members are coalesced and sent in FCM batches by the dispatcher
+    for member, ok in zip(recipients, delivered):
+        if not ok:
+            notifier.enqueue(member, sender, text)
+
+async def mark_group_read(phone: str, group_id: str, seq: int) -> bool:
+    """Move the member's read cursor forward to `seq`; never backwards, never past the group's seq."""
+    if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+        return False
+    cursor = f"read_seq.{phone}"
+    result = await conversations_collection.update_one(
+        {"_id": group_id, "type": "group", "members": phone},
+        [{"$set": {cursor: {"$max": [
+            {"$ifNull": [f"${cursor}", 0]},
+            {"$min": [{"$literal": seq}, {"$ifNull": ["$seq", 0]}]}
+        ]}}}]
+    )
+    return result.modified_count > 0
+
+async def _get_member_group(group_id: str, phone: str, projection: dict = None) -> dict:
+    group = await conversations_collection.find_one({"_id": group_id, "type": "group", "members": phone}, projection)
+    if group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return group
+
+async def _existing_users(phones: list) -> list:
+    return [u["phone_number"] async for u in users_collection.find({"phone_number": {"$in": phones}}, {"_id": 0, "phone_number": 1})]
+
+@router.post("/")
+async def create_group(data: GroupCreateRequest, user: dict = Depends(get_current_user)):
+    owner = user["phone_number"]
+    requested = list(dict.fromkeys([owner] + data.members))
+    if len(requested) > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"Groups are limited to {GROUP_MAX_MEMBERS} members")
+    members = await _existing_users(requested)
+    group_id = f"group_{uuid.uuid4().hex}"
+    await conversations_collection.insert_one({
+        "_id": group_id,
+        "type": "group",
+        "name": data.name,
+        "owner": owner,
+        "members": members,
+        "member_count": len(members),
+        "seq": 0,
+        "read_seq": {},
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "last_message": "",
+        "last_message_time": "",
+    })
+    await _notify_members(members, {"type": "group_update", "group_id": group_id, "event": "created"})
+    return {"group_id": group_id, "members": members}
+
+@router.get("/")
+async def list_groups(user: dict = Depends(get_current_user)):
+    summary = await get_groups_summary(user["phone_number"])
+    return sorted(summary.values(), key=lambda g: g["last_message_time"], reverse=True)
+
+@router.get("/{group_id}")
+async def get_group(group_id: str, user: dict = Depends(get_current_user)):
+    group = await _get_member_group(group_id, user["phone_number"])
+    return {
+        "group_id": group["_id"],
+        "name": group.get("name", ""),
+        "owner": group.get("owner"),
+        "members": group.get("members", []),
+        "seq": group.get("seq", 0),
+        # Lets clients show "seen by" without a per-message status
+        "read_seq": group.get("read_seq", {}),
+    }
+
+@router.post("/{group_id}/members")
+async def add_members(group_id: str, data: GroupMembersRequest, user: dict = Depends(get_current_user)):
+    group = await _get_member_group(group_id, user["phone_number"], {"owner": 1, "members": 1})
+    if group.get("owner") != user["phone_number"]:
+        raise HTTPException(status_code=403, detail="Only the owner can add members")
+    new_members = [p for p in await _existing_users(data.members) if p not in group["members"]]
+    if not new_members:
+        return {"added": []}
+    if len(group["members"]) + len(new_members) > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"Groups are limited to {GROUP_MAX_MEMBERS} members")
+    # New members start with everything before now already read
+    await conversations_collection.update_one(
+        {"_id": group_id},
+        [
+            {"$set": {"members": {"$setUnion": ["$members", new_members]}}},
+            {"$set": {"member_count": {"$size": "$members"}}},
+            {"$set": {f"read_seq.{p}": {"$ifNull": [f"$read_seq.{p}", "$seq"]} for p in new_members}},
+        ]
+    )
+    await _notify_members(group["members"] + new_members, {"type": "group_update", "group_id": group_id, "event": "members_added", "members": new_members})
+    return {"added": new_members}
+
+@router.delete("/{group_id}/members/{phone_number}")
+async def remove_member(group_id: str, phone_number: str, user: dict = Depends(get_current_user)):
+    me = user["phone_number"]
+    group = await _get_member_group(group_id, me, {"owner": 1, "members": 1})
+    if phone_number != me and group.get("owner") != me:
+        raise HTTPException(status_code=403, detail="Only the owner can remove other members")
+    result = await conversations_collection.update_one(
+        {"_id": group_id, "members": phone_number},
+        {"$pull": {"members": phone_number}, "$inc": {"member_count": -1}, "$unset": {f"read_seq.{phone_number}": ""}}
+    )
+    if not result.modified_count:
+        raise HTTPException(status_code=404, detail="Not a member")
+    await _notify_members(group["members"], {"type": "group_update", "group_id": group_id, "event": "member_removed", "member": phone_number})
+    return {"message": "Member removed"}
+
+@router.get("/{group_id}/history")
+async def get_group_history(
+    group_id: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=100),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    await _get_member_group(group_id, user["phone_number"], {"_id": 1})
+    before_pos = after_pos = None
+    if before:
+        before_pos = decode_cursor(before)
+    if after:
+        after_pos = decode_cursor(after)
+    if (before and before_pos is None) or (after and after_pos is None):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    messages = await get_history_page(group_id, limit, before=before_pos, after=after_pos, projection=GROUP_HISTORY_PROJECTION)
+    if messages:
+        response.headers["X-Before-Cursor"] = encode_cursor(messages[0])
+        response.headers["X-After-Cursor"] = encode_cursor(messages[-1])
+    return messages
+
+@router.post("/{group_id}/read/{seq}")
+async def read_group(group_id: str, seq: int, user: dict = Depends(get_current_user)):
+    await _get_member_group(group_id, user["phone_number"], {"_id": 1})
+    await mark_group_read(user["phone_number"], group_id, seq)
+    return {"message": "Read cursor updated"}
@@ -0,0 +1,122 @@
+import asyncio
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+from models import db
+from metrics import log
+from conversations import conversation_id
+
+# Every index the hot paths depend on, per collection
+REQUIRED_INDEXES = {
+    "users": [
+        IndexModel([("phone_number", ASCENDING)], name="phone_number_unique", unique=True),
+        IndexModel([("username_lower", ASCENDING), ("phone_number", ASCENDING)], name="username_lower_phone"),
+    ],
+    "chats": [
+        IndexModel([("conversation_id", ASCENDING), ("time", DESCENDING), ("_id", DESCENDING)], name="conversation_time_id"),
+        IndexModel([("to", ASCENDING), ("from", ASCENDING), ("status", ASCENDING)], name="to_from_status"),
+        # Offline drain and reconnect sync
+        IndexModel([("to", ASCENDING), ("status", ASCENDING), ("time", ASCENDING), ("_id", ASCENDING)], name="to_status_time_id"),
+        IndexModel([("to", ASCENDING), ("time", ASCENDING), ("_id", ASCENDING)], name="to_time_id"),
+        IndexModel([("from", ASCENDING), ("time", ASCENDING), ("_id", ASCENDING)], name="from_time_id"),
+    ],
+    "friend_requests": [
+        IndexModel([("to", ASCENDING), ("status", ASCENDING)], name="to_status"),
+        IndexModel([("from", ASCENDING), ("status", ASCENDING)], name="from_status"),
+    ],
+    "conversations": [
+        # A user's groups, for the unread summary
+        IndexModel([("members", ASCENDING), ("type", ASCENDING)], name="members_type"),
+    ],
+    "archive_segments": [
+        # History fall-through: a conversation's segments by time range
+        IndexModel([("conversation_id", ASCENDING), ("last_time", ASCENDING)], name="conversation_last_time"),
+        IndexModel([("conversation_id", ASCENDING), ("first_time", ASCENDING)], name="conversation_first_time"),
+    ],
+    "tombstones": [
+        # The purge loop's pending tombstones
+        IndexModel([("purged_at", ASCENDING)], name="purged_at"),
+    ],
+    "presence": [
+        IndexModel([("phone_number", ASCENDING)], name="phone_number_unique", unique=True),
+    ],
+}
+
+async def missing_indexes() -> dict:
+    """{collection: [index names]} for required indexes that don't exist; reads index metadata only."""
+    missing = {}
+    for collection_name, models in REQUIRED_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        absent = [m.document["name"] for m in models if m.document["name"] not in existing]
+        if absent:
+            missing[collection_name] = absent
+    return missing
+
+async def ensure_indexes() -> dict:
+    """Create any missing required index and return {collection: [missing index names]} for those that failed."""
+    missing = {}
+    for collection_name, models in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        wanted = [m for m in models if m.document["name"] not in existing]
+        if not wanted:
+            continue
+        try:
+            await collection.create_indexes(wanted)
+        except OperationFailure as e:
+            # e.g. duplicate phone numbers blocking a unique index
+            log("indexes.create_failed", collection=collection_name, error=str(e))
+        existing = await collection.index_information()
+        failed = [m.document["name"] for m in models if m.document["name"] not in existing]
+        if failed:
+            missing[collection_name] = failed
+    return missing
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+def uses_collection_scan(explain: dict) -> bool:
+    winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+    return "COLLSCAN" in set(_plan_stages(winning_plan))
+
+async def check_query_plans(sample_phone: str = "+910000000000", sample_friend: str = "+910000000001") -> list:
+    """Explain the hot queries and return the names of those that fall back to a collection scan."""
+    cid = conversation_id(sample_phone, sample_friend)
+    hot_queries = {
+        "users.by_phone": db["users"].find({"phone_number": sample_phone}),
+        "users.directory": db["users"].find({"username_lower": {"$regex": "^a"}}).sort(
+            [("username_lower", 1), ("phone_number", 1)]
+        ).limit(50),
+        "chats.history": db["chats"].find({"conversation_id": cid}).sort([("time", -1), ("_id", -1)]).limit(50),
+        "chats.unread_from_friend": db["chats"].find(
+            {"from": sample_friend, "to": sample_phone, "status": {"$in": ["sent", "delivered"]}}
+        ),
+        "chats.pending_delivery": db["chats"].find({"to": sample_phone, "status": "sent"}).sort(
+            [("time", 1), ("_id", 1)]
+        ).limit(200),
+        "conversations.summary": db["conversations"].find({"_id": {"$in": [cid]}}),
+        "conversations.groups": db["conversations"].find({"members": sample_phone, "type": "group"}),
+        "friend_requests.pending": db["friend_requests"].find({"to": sample_phone, "status": "pending"}),
+        "friend_requests.sent": db["friend_requests"].find({"from": sample_phone, "status": "pending"}),
+        "presence.by_phone": db["presence"].find({"phone_number": sample_phone}),
+    }
+    scans = []
+    for name, cursor in hot_queries.items():
+        if uses_collection_scan(await cursor.explain()):
+            scans.append(name)
+    return scans
+
+if __name__ == "__main__":
+    # python indexes.py  -> create missing indexes and verify the hot query plans
+    async def main():
+        missing = await ensure_indexes()
+        scans = await check_query_plans()
+        print(f"Missing indexes: {missing or 'none'}")
+        print(f"Collection scans: {scans or 'none'}")
+        raise SystemExit(1 if missing or scans else 0)
+
+    asyncio.run(main())
@@ -0,0 +1,556 @@
+"""Load test for the chat and friends flows.
+
+Boots main.app in-process (uvicorn) against a throwaway database on a local MongoDB,
+with a fake FCM backend, then drives it with WebSocket clients and REST pollers:
+
+    MONGODB_URI=mongodb://localhost:27017 python loadtest.py --clients 2000 --duration 30
+    python loadtest.py --save-baseline      # store this run as loadtest_baseline.json
+    python loadtest.py                      # exit 1 if a number regressed past --tolerance
+
+    python loadtest.py --login-storm        # WebSocket ping latency, idle vs. during a burst of logins
+    python loadtest.py --ws-rtt             # WebSocket ping latency, idle vs. under database-bound REST load
+    MESSAGE_BUS_URL=redis://localhost:6379 python loadtest.py --nodes 3
+                                            # N worker processes on one bus; cross-node delivery latency
+
+The login storm hashes at the real cost factor (BCRYPT_ROUNDS=12 unless set), so a
+password check that blocked the event loop shows up directly in the ping latency.
+
+Needs httpx and websockets (both in requirements.txt; websockets comes with uvicorn[standard]).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timezone
+
+# Must be set before the app modules are imported
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ["MONGODB_DB"] = os.getenv("LOADTEST_DB", "chitchat_loadtest")
+# Cheap hashes for the chat run; the login storm measures the real cost
+os.environ.setdefault("BCRYPT_ROUNDS", "12" if "--login-storm" in sys.argv else "4")
+# A standalone mongod can't run transactions; set MONGODB_TRANSACTIONS=1 against a replica set
+os.environ.setdefault("MONGODB_TRANSACTIONS", "0")
+# Measure the server under load rather than its load shedding (503s and 1013 closes)
+os.environ.setdefault("LOAD_SHED_LAG", "1000000")
+os.environ.setdefault("IMAGE_STORAGE", "local")
+# chat.py verifies socket tokens with its own hardcoded key, so sign logins with the same one
+os.environ["SECRET_KEY"] = "your_secret_key"
+# The in-process server runs alone on InMemoryBus; only --nodes workers get the real bus
+BUS_URL = os.environ.pop("MESSAGE_BUS_URL", None)
+# Every simulated user registers and logs in from this one address
+os.environ.setdefault("RATE_LIMITS_REST", "login=1000000:1000000,register=1000000:1000000")
+
+import httpx
+import uvicorn
+import websockets
+from pymongo import UpdateOne
+
+import main
+from chat import notifier
+from models import client, db, users_collection
+from cache import invalidate_user
+from metrics import metrics
+from migrations import run_migrations
+
+BASELINE_PATH = "loadtest_baseline.json"
+LOGIN_STORM_BASELINE_PATH = "loadtest_login_storm_baseline.json"
+WS_RTT_BASELINE_PATH = "loadtest_ws_rtt_baseline.json"
+MULTI_NODE_BASELINE_PATH = "loadtest_multi_node_baseline.json"
+# Higher is better for these; every other compared number is a latency or a cost
+HIGHER_IS_BETTER = {"messages_per_sec", "rest_requests_per_sec", "logins_per_sec"}
+# Collections written on the message path, for the per-message DB cost
+MESSAGE_PATH_COLLECTIONS = {"chats", "conversations"}
+REST_ROUTES = ["/profile/friends_summary/", "/friends/all_users_and_friends/"]
+# Stays under PASSWORD_MAX_PENDING so setup never sees the password pool's 503s
+SETUP_CONCURRENCY = 16
+
+class FakeFCMBackend:
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_batch(self, notifications):
+        await asyncio.sleep(self.latency)
+        self.sent += len(notifications)
+
+def percentile(samples: list, p: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+def latency_summary(samples: list) -> dict:
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+    }
+
+def mongo_command_count(collections=None) -> int:
+    with metrics._lock:
+        return sum(
+            h.count for (name, labels), h in metrics.histograms.items()
+            if name == "mongo_command_seconds" and (collections is None or dict(labels)["collection"] in collections)
+        )
+
+def phone_for(i: int) -> str:
+    return f"+91{9000000000 + i}"
+
+class Stats:
+    def __init__(self):
+        self.sent_at = {}
+        self.ack = []
+        self.delivery = []
+        self.cross_node_delivery = []
+        self.rest = {route: [] for route in REST_ROUTES}
+        self.frames_sent = {"message": 0, "typing": 0, "read_receipt": 0}
+        self.errors = 0
+
+async def setup_users(http: httpx.AsyncClient, count: int, friends: int, concurrency: int) -> dict:
+    """Register and log in `count` users on a ring where each has `friends` neighbours; returns {phone: token}."""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def register(i):
+        async with limit:
+            r = await http.post("/auth/register/", json={
+                "phone_number": phone_for(i), "username": f"user{i:06d}", "password": "loadtest"
+            })
+            r.raise_for_status()
+
+    await asyncio.gather(*(register(i) for i in range(count)))
+
+    half = max(1, friends // 2)
+    ops = []
+    for i in range(count):
+        ring = {phone_for((i + d) % count) for d in range(-half, half + 1) if d} - {phone_for(i)}
+        ops.append(UpdateOne({"phone_number": phone_for(i)}, {"$set": {"friends": sorted(ring)}}))
+    await users_collection.bulk_write(ops, ordered=False)
+    await invalidate_user(*(phone_for(i) for i in range(count)))
+
+    tokens = {}
+
+    async def login(i):
+        async with limit:
+            r = await http.post("/auth/login/", json={"phone_number": phone_for(i), "password": "loadtest"})
+            r.raise_for_status()
+            tokens[phone_for(i)] = r.json()["access_token"]
+
+    await asyncio.gather(*(login(i) for i in range(count)))
+    return tokens
+
+async def ws_client(base_url: str, phone: str, token: str, friends: list, stats: Stats,
+                    rate: float, stop: asyncio.Event, connected: asyncio.Semaphore, node: int = 0):
+    url = f"{base_url}/chat/ws/{phone}?token={token}"
+    async with connected:
+        ws = await websockets.connect(url, max_size=None, ping_interval=None, open_timeout=60)
+
+    async def receive():
+        try:
+            async for raw in ws:
+                frame = json.loads(raw)
+                kind = frame.get("type")
+                if kind == "delivery_receipt":
+                    started = stats.sent_at.pop(frame.get("client_temp_id"), None)
+                    if started is not None:
+                        stats.ack.append(time.perf_counter() - started)
+                elif kind == "message" and frame.get("message", "").startswith("lt:"):
+                    # "lt:<sender's node>:<send time>"
+                    _, sender_node, sent = frame["message"].split(":", 2)
+                    latency = time.perf_counter() - float(sent)
+                    stats.delivery.append(latency)
+                    if int(sender_node) != node:
+                        stats.cross_node_delivery.append(latency)
+        except websockets.ConnectionClosed:
+            pass
+
+    receiver = asyncio.create_task(receive())
+    try:
+        while not stop.is_set():
+            await asyncio.sleep(random.expovariate(rate))
+            if stop.is_set():
+                break
+            friend = random.choice(friends)
+            roll = random.random()
+            if roll < 0.6:
+                temp_id = f"{phone}-{time.perf_counter_ns()}"
+                stats.sent_at[temp_id] = time.perf_counter()
+                frame = {"type": "message", "to": friend, "message": f"lt:{node}:{time.perf_counter()}", "client_temp_id": temp_id}
+                kind = "message"
+            elif roll < 0.85:
+                frame = {"type": "typing", "to": friend, "is_typing": random.random() < 0.7}
+                kind = "typing"
+            else:
+                frame = {"type": "read_receipt", "sender": friend, "up_to_time": datetime.now(timezone.utc).isoformat()}
+                kind = "read_receipt"
+            await ws.send(json.dumps(frame))
+            stats.frames_sent[kind] += 1
+    except websockets.ConnectionClosed:
+        stats.errors += 1
+    finally:
+        # Let in-flight receipts arrive before closing
+        await asyncio.sleep(1)
+        receiver.cancel()
+        await ws.close()
+
+async def rest_poller(http: httpx.AsyncClient, tokens: dict, stats: Stats, stop: asyncio.Event):
+    phones = list(tokens)
+    while not stop.is_set():
+        route = random.choice(REST_ROUTES)
+        headers = {"Authorization": f"Bearer {tokens[random.choice(phones)]}"}
+        started = time.perf_counter()
+        r = await http.get(route, headers=headers)
+        if r.status_code != 200:
+            stats.errors += 1
+            # Don't spin against a server that is refusing requests
+            await asyncio.sleep(0.1)
+            continue
+        stats.rest[route].append(time.perf_counter() - started)
+
+async def start_server(args):
+    await client.drop_database(db.name)
+    await run_migrations()
+    notifier.backend = FakeFCMBackend()
+
+    config = uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning", ws_max_size=1 << 20)
+    server = uvicorn.Server(config)
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, serving
+
+async def stop_server(args, server, serving):
+    server.should_exit = True
+    await serving
+    if not args.keep_db:
+        await client.drop_database(db.name)
+
+async def run(args) -> dict:
+    server, serving = await start_server(args)
+
+    base = f"127.0.0.1:{args.port}"
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.rest_workers + 50)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://{base}", timeout=60, limits=limits) as http:
+            tokens = await setup_users(http, args.clients, args.friends, concurrency=SETUP_CONCURRENCY)
+            user_docs = {u["phone_number"]: u["friends"] async for u in users_collection.find({}, {"phone_number": 1, "friends": 1})}
+
+            stop = asyncio.Event()
+            connecting = asyncio.Semaphore(100)
+            clients = [
+                asyncio.create_task(ws_client(f"ws://{base}", phone, token, user_docs[phone], stats, args.rate, stop, connecting))
+                for phone, token in tokens.items()
+            ]
+            pollers = [asyncio.create_task(rest_poller(http, tokens, stats, stop)) for _ in range(args.rest_workers)]
+
+            commands_before = mongo_command_count(MESSAGE_PATH_COLLECTIONS)
+            started = time.perf_counter()
+            await asyncio.sleep(args.duration)
+            stop.set()
+            elapsed = time.perf_counter() - started
+            await asyncio.gather(*pollers, return_exceptions=True)
+            results = await asyncio.gather(*clients, return_exceptions=True)
+            stats.errors += sum(1 for r in results if isinstance(r, Exception))
+            commands = mongo_command_count(MESSAGE_PATH_COLLECTIONS) - commands_before
+    finally:
+        await stop_server(args, server, serving)
+
+    messages = stats.frames_sent["message"]
+    rest_samples = [s for samples in stats.rest.values() for s in samples]
+    return {
+        "clients": args.clients,
+        "duration_s": round(elapsed, 1),
+        "frames_sent": stats.frames_sent,
+        "messages_per_sec": round(messages / elapsed, 1),
+        "message_ack": latency_summary(stats.ack),
+        "message_delivery": latency_summary(stats.delivery),
+        "rest_requests_per_sec": round(len(rest_samples) / elapsed, 1),
+        "rest": {route: latency_summary(samples) for route, samples in stats.rest.items()},
+        # Commands on chats/conversations (read receipts included) per message sent
+        "db_ops_per_message": round(commands / messages, 2) if messages else 0.0,
+        "fcm_sent": notifier.backend.sent,
+        "errors": stats.errors,
+    }
+
+async def ping_client(base_url: str, phone: str, token: str, samples: dict, phase: list,
+                      interval: float, stop: asyncio.Event, connected: asyncio.Semaphore):
+    """Time WebSocket ping/pong round trips; the server answers on the same event loop as everything else."""
+    async with connected:
+        ws = await websockets.connect(f"{base_url}/chat/ws/{phone}?token={token}", ping_interval=None, open_timeout=60)
+
+    async def drain():
+        # Unread frames would eventually stop the client from reading pongs
+        try:
+            async for _ in ws:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+
+    reader = asyncio.create_task(drain())
+    try:
+        await asyncio.sleep(random.random() * interval)
+        while not stop.is_set():
+            started = time.perf_counter()
+            await (await ws.ping())
+            samples[phase[0]].append(time.perf_counter() - started)
+            await asyncio.sleep(interval)
+    finally:
+        reader.cancel()
+        await ws.close()
+
+async def login_worker(http: httpx.AsyncClient, phones: list, latencies: list, statuses: dict, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        r = await http.post("/auth/login/", json={"phone_number": random.choice(phones), "password": "loadtest"})
+        statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+        if r.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            # 503 when the password pool is saturated; back off like a client would
+            await asyncio.sleep(float(r.headers.get("Retry-After", "0.1")))
+
+async def ping_under_load(args, clients: int, start_load):
+    """Ping over `clients` open sockets for half of --duration with no other load, then for the other
+    half while `start_load(http, tokens, stop)` (which returns its tasks) runs; returns (samples, elapsed, errors)."""
+    server, serving = await start_server(args)
+    base = f"127.0.0.1:{args.port}"
+    samples = {"idle": [], "load": []}
+    phase = ["idle"]
+    try:
+        async with httpx.AsyncClient(base_url=f"http://{base}", timeout=60) as http:
+            tokens = await setup_users(http, clients, args.friends, concurrency=SETUP_CONCURRENCY)
+            stop = asyncio.Event()
+            connecting = asyncio.Semaphore(100)
+            pingers = [
+                asyncio.create_task(ping_client(f"ws://{base}", phone, token, samples, phase, args.ping_interval, stop, connecting))
+                for phone, token in tokens.items()
+            ]
+            await asyncio.sleep(args.duration / 2)
+
+            phase[0] = "load"
+            load_stop = asyncio.Event()
+            workers = start_load(http, tokens, load_stop)
+            started = time.perf_counter()
+            await asyncio.sleep(args.duration / 2)
+            load_stop.set()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            results = await asyncio.gather(*workers, *pingers, return_exceptions=True)
+            errors = sum(1 for r in results if isinstance(r, Exception))
+    finally:
+        await stop_server(args, server, serving)
+    return samples, elapsed, errors
+
+async def run_login_storm(args) -> dict:
+    """Ping latency with no other load, then while `--storm-workers` clients log in nonstop."""
+    latencies, statuses = [], {}
+
+    def start_load(http, tokens, stop):
+        return [
+            asyncio.create_task(login_worker(http, list(tokens), latencies, statuses, stop))
+            for _ in range(args.storm_workers)
+        ]
+
+    # Registration hashes at full cost too, hence fewer clients than the chat run
+    samples, elapsed, errors = await ping_under_load(args, args.storm_clients, start_load)
+    return {
+        "mode": "login_storm",
+        "clients": args.storm_clients,
+        "storm_workers": args.storm_workers,
+        "bcrypt_rounds": int(os.environ["BCRYPT_ROUNDS"]),
+        "ws_ping_idle": latency_summary(samples["idle"]),
+        "ws_ping_during_storm": latency_summary(samples["load"]),
+        "logins_per_sec": round(len(latencies) / elapsed, 1),
+        "login": latency_summary(latencies),
+        "login_status": {str(code): count for code, count in sorted(statuses.items())},
+        "errors": errors,
+    }
+
+async def run_ws_rtt(args) -> dict:
+    """Ping latency with no other load, then while --rest-workers hammer the database-backed REST routes.
+
+    A blocking database driver stalls the event loop for every query, which shows up here as ping p99.
+    """
+    stats = Stats()
+
+    def start_load(http, tokens, stop):
+        return [asyncio.create_task(rest_poller(http, tokens, stats, stop)) for _ in range(args.rest_workers)]
+
+    samples, elapsed, errors = await ping_under_load(args, args.storm_clients, start_load)
+    rest_samples = [s for timings in stats.rest.values() for s in timings]
+    return {
+        "mode": "ws_rtt",
+        "clients": args.storm_clients,
+        "rest_workers": args.rest_workers,
+        "ws_ping_idle": latency_summary(samples["idle"]),
+        "ws_ping_during_db_load": latency_summary(samples["load"]),
+        "rest_requests_per_sec": round(len(rest_samples) / elapsed, 1),
+        "rest": {route: latency_summary(timings) for route, timings in stats.rest.items()},
+        "errors": errors + stats.errors,
+    }
+
+async def start_nodes(args) -> list:
+    """Run --nodes worker processes of main:app on consecutive ports, all on the same message bus."""
+    await client.drop_database(db.name)
+    await run_migrations()
+    nodes = []
+    for i in range(args.nodes):
+        env = dict(os.environ, MESSAGE_BUS_URL=args.bus_url, NODE_ID=f"loadtest-{i}", RETENTION_WORKER="0")
+        nodes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port + i),
+             "--log-level", "warning", "--ws-max-size", str(1 << 20)],
+            env=env,
+        ))
+    async with httpx.AsyncClient(timeout=1) as http:
+        for i in range(args.nodes):
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    if (await http.get(f"http://127.0.0.1:{args.port + i}/")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline or nodes[i].poll() is not None:
+                    stop_nodes(nodes)
+                    raise RuntimeError(f"Node {i} didn't start")
+                await asyncio.sleep(0.2)
+    return nodes
+
+def stop_nodes(nodes: list):
+    for node in nodes:
+        node.terminate()
+    for node in nodes:
+        try:
+            node.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            node.kill()
+
+async def run_multi_node(args) -> dict:
+    """Users spread round-robin over the nodes, so ring neighbours chat across nodes through the bus."""
+    nodes = await start_nodes(args)
+    stats = Stats()
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=60) as http:
+            tokens = await setup_users(http, args.clients, args.friends, concurrency=SETUP_CONCURRENCY)
+        user_docs = {u["phone_number"]: u["friends"] async for u in users_collection.find({}, {"phone_number": 1, "friends": 1})}
+
+        stop = asyncio.Event()
+        connecting = asyncio.Semaphore(100)
+        clients = []
+        for i, (phone, token) in enumerate(tokens.items()):
+            node = i % args.nodes
+            clients.append(asyncio.create_task(ws_client(
+                f"ws://127.0.0.1:{args.port + node}", phone, token, user_docs[phone], stats, args.rate, stop, connecting, node
+            )))
+        started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        stop.set()
+        elapsed = time.perf_counter() - started
+        results = await asyncio.gather(*clients, return_exceptions=True)
+        stats.errors += sum(1 for r in results if isinstance(r, Exception))
+    finally:
+        stop_nodes(nodes)
+        if not args.keep_db:
+            await client.drop_database(db.name)
+
+    messages = stats.frames_sent["message"]
+    return {
+        "mode": "multi_node",
+        "nodes": args.nodes,
+        "clients": args.clients,
+        "duration_s": round(elapsed, 1),
+        "frames_sent": stats.frames_sent,
+        "messages_per_sec": round(messages / elapsed, 1),
+        "message_ack": latency_summary(stats.ack),
+        "message_delivery": latency_summary(stats.delivery),
+        "cross_node_delivery": latency_summary(stats.cross_node_delivery),
+        "errors": stats.errors,
+    }
+
+def compared_numbers(results: dict, prefix: str = "") -> dict:
+    numbers = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            numbers.update(compared_numbers(value, f"{name}."))
+        elif key in HIGHER_IS_BETTER or key.endswith("_ms") or key == "db_ops_per_message":
+            numbers[name] = value
+    return numbers
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    current, previous = compared_numbers(results), compared_numbers(baseline)
+    failed = []
+    for name, old in previous.items():
+        new = current.get(name)
+        if new is None or not old:
+            continue
+        if name.rsplit(".", 1)[-1] in HIGHER_IS_BETTER:
+            worse = new < old * (1 - tolerance)
+        else:
+            worse = new > old * (1 + tolerance)
+        if worse:
+            failed.append(f"{name}: {old} -> {new}")
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000, help="concurrent WebSocket clients")
+    parser.add_argument("--friends", type=int, default=4, help="friends per user")
+    parser.add_argument("--rate", type=float, default=0.5, help="frames per second per client")
+    parser.add_argument("--rest-workers", type=int, default=20, help="concurrent REST pollers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--nodes", type=int, default=1, help="worker processes sharing MESSAGE_BUS_URL (2+ measures cross-node delivery)")
+    parser.add_argument("--bus-url", default=BUS_URL, help="Redis URL for --nodes (default: MESSAGE_BUS_URL)")
+    parser.add_argument("--login-storm", action="store_true", help="measure WebSocket latency during a login storm instead")
+    parser.add_argument("--ws-rtt", action="store_true", help="measure WebSocket latency under database-bound REST load instead")
+    parser.add_argument("--storm-clients", type=int, default=100, help="pinging WebSocket clients in the --login-storm and --ws-rtt runs")
+    parser.add_argument("--storm-workers", type=int, default=50, help="concurrent login loops in the storm")
+    parser.add_argument("--ping-interval", type=float, default=0.1, help="seconds between pings per socket in the --login-storm and --ws-rtt runs")
+    parser.add_argument("--baseline", default=None, help="defaults to a per-mode loadtest_*baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--keep-db", action="store_true", help="don't drop the load-test database afterwards")
+    args = parser.parse_args()
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        # Each client holds two sockets (client and server side) in this process
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.clients * 2 + 1024)), hard))
+    except (ImportError, ValueError):
+        pass
+
+    if args.nodes > 1 and not args.bus_url:
+        sys.exit("--nodes needs a shared bus: set MESSAGE_BUS_URL or --bus-url to a Redis URL")
+    if args.login_storm:
+        args.baseline = args.baseline or LOGIN_STORM_BASELINE_PATH
+        results = asyncio.run(run_login_storm(args))
+    elif args.ws_rtt:
+        args.baseline = args.baseline or WS_RTT_BASELINE_PATH
+        results = asyncio.run(run_ws_rtt(args))
+    elif args.nodes > 1:
+        args.baseline = args.baseline or MULTI_NODE_BASELINE_PATH
+        results = asyncio.run(run_multi_node(args))
+    else:
+        args.baseline = args.baseline or BASELINE_PATH
+        results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            failed = regressions(results, json.load(f), args.tolerance)
+        if failed:
+            print("Regressions:\n  " + "\n  ".join(failed))
+            sys.exit(1)
+        print("No regressions against baseline")
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
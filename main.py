@@ -1,32 +1,111 @@
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
+import os
+from fastapi.staticfiles import StaticFiles
+import codec
+import storage
+import models
 from auth import router as auth_router
 from profile_routes import router as profile_router
-from chat import router as chat_router
+from chat import router as chat_router, notifier, presence, typing_relay
 from friend_requests import router as friend_requests_router
+from groups import router as groups_router
+from conversations import message_writer
+from connections import registry
+from indexes import missing_indexes
+from migrations import pending_migrations
+from metrics import metrics, loop_lag, log, MetricsMiddleware
+from rate_limit import RateLimitMiddleware
+from retention import retention_worker
+from cache import cache_stats
 
-app = FastAPI()
+class StartupTimer:
+    """Records how long each startup phase takes, in milliseconds."""
 
-""" @app.middleware("http")
-async def log_requests(request, call_next):
-    print(f"Request: {request.method} {request.url}")
-    response = await call_next(request)
-    return response """
+    def __init__(self):
+        self.phases = {}
+
+    @asynccontextmanager
+    async def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((time.perf_counter() - started) * 1000, 1)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only constant-time work here: backfills and index builds run via `python migrations.py`
+    timer = StartupTimer()
+    async with timer.phase("schema_check"):
+        missing = await missing_indexes()
+        pending = await pending_migrations()
+    if missing:
+        log("startup.missing_indexes", indexes=missing)
+    if pending:
+        log("startup.pending_migrations", migrations=pending, hint="run `python migrations.py`")
+    async with timer.phase("message_bus"):
+        await registry.start()
+    async with timer.phase("notifier"):
+        await notifier.start()
+    async with timer.phase("presence"):
+        await presence.start()
+    async with timer.phase("typing_relay"):
+        await typing_relay.start()
+    async with timer.phase("retention"):
+        await retention_worker.start()
+    await loop_lag.start()
+    app.state.startup_timings = timer.phases
+    metrics.gauge("startup_phase_ms", lambda: timer.phases)
+    log("startup.complete", phases_ms=timer.phases)
+    yield
+    await loop_lag.stop()
+    await retention_worker.stop()
+    await typing_relay.stop()
+    await message_writer.stop()
+    await presence.stop()
+    await notifier.stop()
+    await registry.stop()
+
+app = FastAPI(
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse if codec.orjson is not None else JSONResponse,
+)
+
+metrics.gauge("cache", cache_stats)
+metrics.gauge("password_jobs_pending", lambda: models.password_jobs_pending)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def read_root():
     return {"message": "Chit Chat API is running!"}
-    
+
+# Inside CORS so 429/503 responses still carry the CORS headers
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor", "X-Next-Cursor"],
 )
+# Outermost, so the timings include every other middleware
+app.add_middleware(MetricsMiddleware)
+
+if storage.IMAGE_STORAGE == "local":
+    os.makedirs(storage.LOCAL_MEDIA_ROOT, exist_ok=True)
+    app.mount(storage.LOCAL_MEDIA_URL, StaticFiles(directory=storage.LOCAL_MEDIA_ROOT), name="media")
 
 app.include_router(auth_router, prefix="/auth", tags=["Auth"])
 app.include_router(profile_router, prefix="/profile", tags=["Profile"])
 app.include_router(chat_router, prefix="/chat", tags=["Chat"])
 app.include_router(friend_requests_router, prefix="/friends", tags=["Friends"])
+app.include_router(groups_router, prefix="/groups", tags=["Groups"])
  
\ No newline at end of file
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from bisect import bisect_left
+from pymongo import monitoring
+
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+METRICS_PREFIX = "chitchat_"
+# Seconds; covers sub-millisecond frame handling up to slow pushes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def log(event: str, sample_rate: float = 1.0, **fields):
+    """One JSON line per event; `sample_rate` < 1 keeps only that fraction (and records the rate)."""
+    if sample_rate < 1.0:
+        if random.random() >= sample_rate:
+            return
+        fields["sample_rate"] = sample_rate
+    print(json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str))
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+def _flatten(prefix: str, value, out: dict):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten(f"{prefix}_{k}", v, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+
+class Metrics:
+    """In-process counters, histograms and gauges, rendered in the Prometheus text format.
+
+    Updates are a dict lookup and an add under a lock (Mongo events arrive on Motor's threads).
+    Gauges are either set directly or computed by a callback when /metrics is scraped.
+    """
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.values = {}
+        self.callbacks = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def set(self, name: str, value: float, **labels):
+        self.values[(name, _labels(labels))] = value
+
+    def gauge(self, name: str, fn):
+        """Register `fn()` to be read at scrape time; it may return a number or a (nested) dict of numbers."""
+        self.callbacks[name] = fn
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, h.buckets, list(h.counts), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+        for (name, labels), value in counters:
+            lines.append(f"{self.prefix}{name}{_format_labels(labels)} {value}")
+        for (name, labels), buckets, counts, total, count in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.prefix}{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{self.prefix}{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.prefix}{name}_count{_format_labels(labels)} {count}")
+        gauges = {}
+        for (name, labels), value in sorted(self.values.items()):
+            lines.append(f"{self.prefix}{name}{_format_labels(labels)} {value}")
+        for name, fn in self.callbacks.items():
+            try:
+                _flatten(name, fn(), gauges)
+            except Exception as e:
+                log("metrics.gauge_failed", gauge=name, error=str(e))
+        for name, value in sorted(gauges.items()):
+            lines.append(f"{self.prefix}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsMiddleware:
+    """Plain ASGI middleware timing every HTTP request by method and route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router records the matched route in the scope; templates keep label cardinality bounded
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            metrics.observe("http_request_duration_seconds", time.perf_counter() - started, method=method, route=route)
+            metrics.inc("http_requests_total", method=method, route=route, status=status[0])
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every Mongo command by collection and operation (pass to the client's event_listeners)."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if not isinstance(target, str):
+            # getMore carries the cursor id there and the collection separately
+            target = event.command.get("collection", "")
+        self._collections[(event.connection_id, event.request_id)] = target
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, collection=collection, op=event.command_name)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        metrics.inc("mongo_command_errors_total", collection=collection, op=event.command_name)
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a sleeping task; a busy or blocked loop shows up as lag."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            metrics.observe("event_loop_lag_seconds", self.lag)
+
+loop_lag = LoopLagMonitor()
+metrics.gauge("event_loop_lag_seconds_last", lambda: loop_lag.lag)
@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import asyncio
+from datetime import datetime, timezone
+from models import db, users_collection, chats_collection
+from conversations import rebuild_conversations
+from indexes import ensure_indexes, missing_indexes
+
+# One document per migration: {_id: name, last_id, completed_at, duration_s}
+migrations_collection = db["migrations"]
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+
+MIGRATIONS = []
+
+def migration(name: str):
+    def register(fn):
+        MIGRATIONS.append((name, fn))
+        return fn
+    return register
+
+async def _update_in_batches(name: str, collection, query: dict, update, batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """Apply `update` to matching documents in _id order, saving progress after each batch so a rerun resumes."""
+    state = await migrations_collection.find_one({"_id": name}) or {}
+    last_id = state.get("last_id")
+    updated = 0
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+        ids = [doc["_id"] async for doc in collection.find(batch_query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+        if not ids:
+            break
+        result = await collection.update_many({"_id": {"$in": ids}}, update)
+        updated += result.modified_count
+        last_id = ids[-1]
+        await migrations_collection.update_one({"_id": name}, {"$set": {"last_id": last_id}}, upsert=True)
+    return updated
+
+@migration("indexes")
+async def create_indexes(name: str) -> int:
+    # Idempotent, and pending again whenever REQUIRED_INDEXES gains an index (see pending_migrations)
+    missing = await ensure_indexes()
+    if missing:
+        raise RuntimeError(f"Could not create indexes: {missing}")
+    return 0
+
+@migration("user_default_fields")
+async def backfill_user_fields(name: str) -> int:
+    return await _update_in_batches(
+        name, users_collection,
+        {"$or": [{"bio": {"$exists": False}}, {"email": {"$exists": False}}, {"profile_image_url": {"$exists": False}}]},
+        [{"$set": {
+            "bio": {"$ifNull": ["$bio", ""]},
+            "email": {"$ifNull": ["$email", ""]},
+            "profile_image_url": {"$ifNull": ["$profile_image_url", ""]},
+        }}]
+    )
+
+@migration("username_lower")
+async def backfill_username_lower(name: str) -> int:
+    # Lower-cased copy of the username backs the directory's prefix search
+    return await _update_in_batches(
+        name, users_collection,
+        {"username_lower": {"$exists": False}},
+        [{"$set": {"username_lower": {"$toLower": {"$ifNull": ["$username", ""]}}}}]
+    )
+
+@migration("conversation_ids")
+async def stamp_conversation_ids(name: str) -> int:
+    """Add conversation_id to messages written before it existed."""
+    return await _update_in_batches(
+        name, chats_collection,
+        {"conversation_id": {"$exists": False}},
+        [{"$set": {"conversation_id": {"$cond": [
+            {"$lt": ["$from", "$to"]},
+            {"$concat": ["$from", "_", "$to"]},
+            {"$concat": ["$to", "_", "$from"]}
+        ]}}}]
+    )
+
+@migration("conversations")
+async def build_conversations(name: str) -> int:
+    # Idempotent; an interrupted run just starts over
+    return await rebuild_conversations()
+
+async def pending_migrations() -> list:
+    done = {doc["_id"] async for doc in migrations_collection.find({"completed_at": {"$exists": True}}, {"_id": 1})}
+    if await missing_indexes():
+        done.discard("indexes")
+    return [name for name, _ in MIGRATIONS if name not in done]
+
+async def run_migrations(names: list = None) -> dict:
+    """Run pending migrations in order (or just `names`, even if already completed); returns {name: documents changed}."""
+    pending = set(names) if names else set(await pending_migrations())
+    results = {}
+    for name, fn in MIGRATIONS:
+        if name not in pending:
+            continue
+        if names:
+            await migrations_collection.update_one({"_id": name}, {"$unset": {"last_id": "", "completed_at": ""}})
+        started = time.perf_counter()
+        results[name] = await fn(name)
+        duration = time.perf_counter() - started
+        await migrations_collection.update_one(
+            {"_id": name},
+            {"$set": {"completed_at": datetime.now(timezone.utc).isoformat(), "duration_s": round(duration, 3)},
+             "$unset": {"last_id": ""}},
+            upsert=True
+        )
+        print(f"Migration {name}: {results[name]} documents in {duration:.2f}s")
+    return results
+
+if __name__ == "__main__":
+    # python migrations.py            -> run every migration that hasn't completed yet
+    # python migrations.py NAME ...   -> (re)run the named migrations
+    # python migrations.py --status   -> list pending migrations
+    async def main(args):
+        if args == ["--status"]:
+            pending = await pending_migrations()
+            print(f"Pending migrations: {pending or 'none'}")
+            return
+        unknown = set(args) - {name for name, _ in MIGRATIONS}
+        if unknown:
+            sys.exit(f"Unknown migrations: {sorted(unknown)}")
+        await run_migrations(args or None)
+
+    asyncio.run(main(sys.argv[1:]))
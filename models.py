@@ -1,44 +1,103 @@
 import os
-from pymongo import MongoClient, ReturnDocument
+import time
+import asyncio
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from cache import token_cache, get_cached_user, cache_user, invalidate_user, user_generation
+from metrics import MongoCommandTimer
 
 load_dotenv()
 
-client = MongoClient(os.getenv("MONGODB_URI"))
-db = client["chat_app"]
+# One shared client (and connection pool) per worker process
+client = AsyncIOMotorClient(
+    os.getenv("MONGODB_URI"),
+    maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE", "100")),
+    minPoolSize=int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+    maxIdleTimeMS=int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "0")) or None,
+    waitQueueTimeoutMS=int(os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "0")) or None,
+    event_listeners=[MongoCommandTimer()],
+)
+db = client[os.getenv("MONGODB_DB", "chat_app")]
 users_collection = db["users"]
 chats_collection = db["chats"]
 presence_collection = db["presence"]
-users_collection.update_many({"bio": {"$exists": False}}, {"$set": {"bio": ""}})
-users_collection.update_many({"email": {"$exists": False}}, {"$set": {"email": ""}})
-users_collection.update_many({"profile_image_url": {"$exists": False}}, {"$set": {"profile_image_url": ""}})
 
 SECRET_KEY = os.getenv("SECRET_KEY", "super-secret-key")
 ALGORITHM = "HS256"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login/")
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "32"))
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+# bcrypt is CPU bound; it runs here so it never stalls the event loop
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+password_jobs_pending = 0
+
+async def _run_password_job(fn, *args):
+    global password_jobs_pending
+    if password_jobs_pending >= PASSWORD_MAX_PENDING:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please try again",
+            headers={"Retry-After": "1"},
+        )
+    password_jobs_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_pool, fn, *args)
+    finally:
+        password_jobs_pending -= 1
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
-def register_user(user_data: dict):
-    if users_collection.find_one({"phone_number": user_data["phone_number"]}):
+async def hash_password(password: str) -> str:
+    return await _run_password_job(_hash_password, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_job(_verify_password, plain_password, hashed_password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    # $2b$<cost>$<salt+hash>
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+async def register_user(user_data: dict):
+    if await users_collection.find_one({"phone_number": user_data["phone_number"]}):
         return False
-    user_data["password"] = hash_password(user_data["password"])
-    users_collection.insert_one(user_data)
+    user_data["password"] = await hash_password(user_data["password"])
+    user_data["username_lower"] = user_data.get("username", "").lower()
+    await users_collection.insert_one(user_data)
     return True
 
-def authenticate_user(phone_number: str, password: str):
-    user = users_collection.find_one({"phone_number": phone_number})
-    if user and verify_password(password, user["password"]):
+async def authenticate_user(phone_number: str, password: str):
+    user = await users_collection.find_one({"phone_number": phone_number})
+    if user and await verify_password(password, user["password"]):
+        if password_needs_rehash(user["password"]):
+            # Upgrade hashes made with an outdated cost factor while we have the plain password
+            try:
+                new_hash = await hash_password(password)
+            except HTTPException:
+                return user  # pool saturated, upgrade on a later login
+            await users_collection.update_one(
+                {"phone_number": phone_number, "password": user["password"]},
+                {"$set": {"password": new_hash}}
+            )
+            await invalidate_user(phone_number)
         return user
     return None
 
@@ -46,56 +105,58 @@ def create_access_token(user: dict):
     expire = datetime.utcnow() + timedelta(days=30)
     return jwt.encode({"sub": user["phone_number"], "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_user_by_phone(phone_number):
+async def get_user_by_phone(phone_number):
     """ print(f"Looking for phone: {phone_number}") """
-    user = users_collection.find_one({"phone_number": phone_number})
+    user = get_cached_user(phone_number)
+    if user is not None:
+        return user
+    generation = user_generation(phone_number)
+    user = await users_collection.find_one({"phone_number": phone_number})
     if user:
         user["_id"] = str(user["_id"])
+        cache_user(user, generation)
     return user
 
-def update_user_profile(phone_number, update_data):
-    user = users_collection.find_one_and_update(
+async def update_user_profile(phone_number, update_data):
+    if "username" in update_data:
+        update_data["username_lower"] = update_data["username"].lower()
+    user = await users_collection.find_one_and_update(
         {"phone_number": phone_number},
         {"$set": update_data},
         return_document=ReturnDocument.AFTER
     )
+    await invalidate_user(phone_number)
     if user:
         user["_id"] = str(user["_id"])
     return user
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def verify_token(token: str) -> Optional[str]:
+    """The phone number a valid, unexpired token was issued to, else None."""
+    phone_number = token_cache.get(token)
+    if phone_number is not None:
+        return phone_number
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    phone_number = payload.get("sub")
+    if phone_number is None:
+        return None
+    # Never trust a cached token past its own expiry
+    expires_at = payload.get("exp")
+    token_cache.set(token, phone_number, ttl=expires_at - time.time() if expires_at else None)
+    return phone_number
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        
-        phone_number: str = payload.get("sub") # type: ignore
-        if phone_number is None:
-            raise credentials_exception
-    except JWTError:
+    phone_number = verify_token(token)
+    if phone_number is None:
         raise credentials_exception
-    user = get_user_by_phone(phone_number)
+    user = await get_user_by_phone(phone_number)
     if user is None:
         raise credentials_exception
     return user
-
-def set_user_online(phone_number: str):
-    presence_collection.update_one(
-        {"phone_number": phone_number},
-        {"$set": {"online": True}},
-        upsert=True
-    )
-
-def set_user_offline(phone_number: str):
-    presence_collection.update_one(
-        {"phone_number": phone_number},
-        {"$set": {"online": False}},
-        upsert=True
-    )
-
-def is_user_online(phone_number: str) -> bool:
-    doc = presence_collection.find_one({"phone_number": phone_number})
-    return bool(doc and doc.get("online", False))
\ No newline at end of file
@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+from models import users_collection
+from metrics import log
+
+FCM_WORKERS = int(os.getenv("FCM_WORKERS", "2"))
+FCM_COALESCE_WINDOW = float(os.getenv("FCM_COALESCE_WINDOW", "0.5"))
+FCM_BATCH_SIZE = 500  # FCM send_each limit
+FCM_MAX_PENDING = int(os.getenv("FCM_MAX_PENDING", "10000"))
+
+class NotificationDispatcher:
+    """Coalesces push notifications per recipient and sends them in batches off the message path.
+
+    `backend` needs a single coroutine, `send_batch(notifications)`, taking dicts with
+    token/title/body. `is_online` decides at flush time whether a push is still needed.
+    `metrics_hook(name, value)` receives queue depth and dispatch latency samples.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        is_online: Optional[Callable[[str], Awaitable[bool]]] = None,
+        workers: int = FCM_WORKERS,
+        coalesce_window: float = FCM_COALESCE_WINDOW,
+        max_pending: int = FCM_MAX_PENDING,
+        metrics_hook: Optional[Callable[[str, float], None]] = None,
+    ):
+        self.backend = backend
+        self.is_online = is_online
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.max_pending = max_pending
+        self.metrics_hook = metrics_hook
+        self.pending: Dict[str, List[tuple]] = {}
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def enqueue(self, to_phone: str, from_phone: str, message_text: str):
+        """Never blocks; drops the notification if the dispatcher is saturated."""
+        if to_phone not in self.pending and len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.setdefault(to_phone, []).append((from_phone, message_text, time.monotonic()))
+
+    def queue_depth(self) -> int:
+        return len(self.pending) + (self._queue.qsize() if self._queue else 0)
+
+    async def start(self):
+        if self._tasks:
+            return
+        if self.backend is None:
+            from fcm_utils import FirebaseMessagingBackend
+            self.backend = FirebaseMessagingBackend()
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._flush_loop())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._flush()
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _emit(self, name: str, value: float):
+        if self.metrics_hook:
+            self.metrics_hook(name, value)
+
+    def _flush(self):
+        if not self.pending or self._queue is None:
+            return
+        batch, self.pending = self.pending, {}
+        items = list(batch.items())
+        for i in range(0, len(items), FCM_BATCH_SIZE):
+            self._queue.put_nowait(dict(items[i:i + FCM_BATCH_SIZE]))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.coalesce_window)
+            self._emit("fcm.queue_depth", self.queue_depth())
+            self._flush()
+
+    async def _worker(self):
+        while True:
+            batch = await self._queue.get()
+            try:
+                await self._dispatch(batch)
+            except Exception as e:
+                log("fcm.dispatch_failed", error=str(e))
+            finally:
+                self._queue.task_done()
+
+    async def _dispatch(self, batch: Dict[str, List[tuple]]):
+        recipients = [phone for phone in batch if not (self.is_online and await self.is_online(phone))]
+        if not recipients:
+            return
+        senders = {from_phone for phone in recipients for from_phone, _, _ in batch[phone]}
+        users = {}
+        async for u in users_collection.find(
+            {"phone_number": {"$in": recipients + list(senders)}},
+            {"_id": 0, "phone_number": 1, "username": 1, "fcm_token": 1}
+        ):
+            users[u["phone_number"]] = u
+
+        notifications = []
+        for phone in recipients:
+            token = users.get(phone, {}).get("fcm_token")
+            if not token:
+                continue
+            notifications.append({"token": token, **self._render(batch[phone], users)})
+        if notifications:
+            await self.backend.send_batch(notifications)
+
+        now = time.monotonic()
+        oldest = min(queued_at for phone in recipients for _, _, queued_at in batch[phone])
+        self._emit("fcm.dispatch_latency", now - oldest)
+
+    @staticmethod
+    def _render(messages: List[tuple], users: dict) -> dict:
+        senders = {from_phone for from_phone, _, _ in messages}
+        if len(senders) == 1:
+            from_phone = next(iter(senders))
+            title = f"New message from {users.get(from_phone, {}).get('username', from_phone)}"
+        else:
+            title = f"New messages from {len(senders)} chats"
+        if len(messages) == 1:
+            body = messages[0][1]
+        else:
+            body = f"{len(messages)} new messages"
+        return {"title": title, "body": body}
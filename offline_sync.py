@@ -0,0 +1,127 @@
+import os
+import asyncio
+from datetime import datetime, timezone
+from models import chats_collection
+from conversations import conversations_collection, conversation_id, encode_cursor, decode_cursor, HISTORY_PROJECTION
+from connections import Connection, registry
+from retention import get_tombstones
+
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "200"))
+SYNC_PROJECTION = dict(HISTORY_PROJECTION, conversation_id=1)
+
+async def _wait_for_room(connection: Connection):
+    # Don't let a big backlog overflow the socket's outbound queue
+    while not connection.closed and len(connection.frames) > connection.max_size // 2:
+        await asyncio.sleep(0.05)
+
+def _after(position) -> dict:
+    time, message_id = position
+    return {"$or": [{"time": {"$gt": time}}, {"time": time, "_id": {"$gt": message_id}}]}
+
+async def _visible(batch: list) -> list:
+    # Deleted chats stay in `chats` until the retention worker purges them
+    cids = [msg.get("conversation_id") or conversation_id(msg["from"], msg["to"]) for msg in batch]
+    floors = await get_tombstones(cids)
+    return [msg for msg, cid in zip(batch, cids) if cid not in floors or msg["time"] > floors[cid]]
+
+async def drain_pending(phone: str, connection: Connection, batch_size: int = SYNC_BATCH_SIZE) -> int:
+    """Deliver everything that arrived while `phone` was offline, one frame and one update_many per batch."""
+    delivered = 0
+    position = None
+    while not connection.closed:
+        query = {"to": phone, "status": "sent"}
+        if position is not None:
+            query.update(_after(position))
+        found = await (
+            chats_collection.find(query, SYNC_PROJECTION)
+            .sort([("time", 1), ("_id", 1)])
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        if not found:
+            break
+        position = (found[-1]["time"], found[-1]["_id"])
+        batch = await _visible(found)
+        if not batch:
+            if len(found) < batch_size:
+                break
+            continue
+        ids = [msg["_id"] for msg in batch]
+        now = datetime.now(timezone.utc).isoformat()
+
+        await _wait_for_room(connection)
+        queued = connection.push({
+            "type": "message_batch",
+            "messages": [{
+                "type": "message",
+                "from": msg["from"],
+                "to": msg["to"],
+                "message": msg["message"],
+                "message_id": msg["_id"],
+                "time": msg["time"],
+            } for msg in batch],
+            "cursor": encode_cursor(batch[-1]),
+        })
+        # Socket gone or dropped as a slow consumer: leave the batch "sent" for the next drain
+        if not queued or connection.closed:
+            break
+        await chats_collection.update_many(
+            {"_id": {"$in": ids}, "status": "sent"},
+            {"$set": {"status": "delivered", "delivered_at": now}}
+        )
+        by_sender = {}
+        for msg in batch:
+            by_sender.setdefault(msg["from"], []).append(msg["_id"])
+        await conversations_collection.update_many(
+            {"_id": {"$in": [conversation_id(phone, sender) for sender in by_sender]}, "last_message_id": {"$in": ids}},
+            {"$set": {"last_message_status": "delivered"}}
+        )
+        for sender, message_ids in by_sender.items():
+            await registry.send(sender, {
+                "type": "delivery_receipt_batch",
+                "message_ids": message_ids,
+                "status": "delivered"
+            })
+        delivered += len(batch)
+        if len(found) < batch_size:
+            break
+    return delivered
+
+async def sync_since(phone: str, cursor: str, connection: Connection, batch_size: int = SYNC_BATCH_SIZE) -> int:
+    """Replay every message to or from `phone` after the client's last-seen cursor."""
+    # Without a cursor this would replay the user's whole history; pending messages
+    # are already delivered by drain_pending on connect
+    if not cursor:
+        connection.push({"type": "sync_error", "detail": "Cursor required"})
+        return 0
+    position = decode_cursor(cursor)
+    if position is None:
+        connection.push({"type": "sync_error", "detail": "Invalid cursor"})
+        return 0
+    sent = 0
+    while not connection.closed:
+        query = {"$and": [{"$or": [{"to": phone}, {"from": phone}]}, _after(position)]}
+        found = await (
+            chats_collection.find(query, SYNC_PROJECTION)
+            .sort([("time", 1), ("_id", 1)])
+            .limit(batch_size)
+            .to_list(length=batch_size)
+        )
+        done = len(found) < batch_size
+        batch = await _visible(found)
+        for msg in batch:
+            msg.pop("conversation_id", None)
+        await _wait_for_room(connection)
+        if not connection.push({
+            "type": "sync_batch",
+            "messages": batch,
+            # The cursor still moves past hidden messages so the client doesn't ask for them again
+            "cursor": encode_cursor(found[-1]) if found else cursor,
+            "done": done,
+        }):
+            break
+        sent += len(batch)
+        if done:
+            break
+        position = (found[-1]["time"], found[-1]["_id"])
+    return sent
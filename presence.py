@@ -0,0 +1,165 @@
+import os
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+from pymongo import UpdateOne
+from models import presence_collection
+from metrics import log
+
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "90"))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "5"))
+
+# on_change(phone_number, online, last_seen, friends)
+ChangeHandler = Callable[[str, bool, str, List[str]], Awaitable[None]]
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+class PresenceTracker:
+    """Online state for users connected to this worker, written to `presence` lazily in batches.
+
+    Every worker refreshes `last_heartbeat` for its online users at least once per TTL, so a
+    document whose heartbeat is older than the TTL belongs to a dead session and reads as offline.
+    """
+
+    def __init__(
+        self,
+        on_change: Optional[ChangeHandler] = None,
+        is_alive: Optional[Callable[[str], bool]] = None,
+        ttl: int = PRESENCE_TTL,
+        flush_interval: float = PRESENCE_FLUSH_INTERVAL,
+    ):
+        self.on_change = on_change
+        self.is_alive = is_alive
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.sessions: Dict[str, dict] = {}
+        self.dirty = set()
+        self._tasks: List[asyncio.Task] = []
+
+    async def connect(self, phone: str, friends: List[str]):
+        session = self.sessions.get(phone)
+        if session is None or not session["online"]:
+            session = self.sessions[phone] = {
+                "online": True, "count": 0, "last_seen": _now(), "last_heartbeat": _now(), "friends": friends
+            }
+            self.dirty.add(phone)
+            await self._changed(phone, session)
+        session["count"] += 1
+        session["friends"] = friends
+        session["last_heartbeat"] = _now()
+
+    def heartbeat(self, phone: str):
+        session = self.sessions.get(phone)
+        if session is not None and session["online"]:
+            session["last_heartbeat"] = _now()
+
+    async def disconnect(self, phone: str):
+        session = self.sessions.get(phone)
+        if session is None or not session["online"]:
+            return
+        session["count"] -= 1
+        if session["count"] <= 0:
+            await self._go_offline(phone, session)
+
+    async def _go_offline(self, phone: str, session: dict):
+        session["online"] = False
+        session["last_seen"] = _now()
+        self.dirty.add(phone)
+        await self._changed(phone, session)
+
+    async def _changed(self, phone: str, session: dict):
+        if self.on_change:
+            try:
+                await self.on_change(phone, session["online"], session["last_seen"].isoformat(), session["friends"])
+            except Exception as e:
+                log("presence.push_failed", phone=phone, error=str(e))
+
+    async def get_statuses(self, phones: List[str]) -> Dict[str, dict]:
+        """Online flag and last-seen time for many users; one query for those not held by this worker."""
+        statuses = {}
+        remote = []
+        for phone in phones:
+            session = self.sessions.get(phone)
+            if session is not None and session["online"]:
+                statuses[phone] = {"online": True, "last_seen": session["last_seen"].isoformat()}
+            else:
+                remote.append(phone)
+        if remote:
+            cutoff = _now() - timedelta(seconds=self.ttl)
+            async for doc in presence_collection.find({"phone_number": {"$in": remote}}):
+                heartbeat = doc.get("last_heartbeat")
+                if heartbeat is not None and heartbeat.tzinfo is None:
+                    heartbeat = heartbeat.replace(tzinfo=timezone.utc)
+                last_seen = doc.get("last_seen")
+                statuses[doc["phone_number"]] = {
+                    "online": bool(doc.get("online")) and heartbeat is not None and heartbeat > cutoff,
+                    "last_seen": last_seen.isoformat() if isinstance(last_seen, datetime) else last_seen,
+                }
+        for phone in phones:
+            statuses.setdefault(phone, {"online": False, "last_seen": None})
+        return statuses
+
+    async def is_online(self, phone: str) -> bool:
+        return (await self.get_statuses([phone]))[phone]["online"]
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for phone, session in list(self.sessions.items()):
+            if session["online"]:
+                session["online"] = False
+                session["last_seen"] = _now()
+                self.dirty.add(phone)
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.expire()
+                await self.flush()
+            except Exception as e:
+                log("presence.flush_failed", error=str(e))
+
+    async def expire(self):
+        """Drop sessions that stopped heartbeating and whose socket is no longer alive."""
+        cutoff = _now() - timedelta(seconds=self.ttl)
+        for phone, session in list(self.sessions.items()):
+            if not session["online"]:
+                if phone not in self.dirty:
+                    del self.sessions[phone]
+                continue
+            if self.is_alive and self.is_alive(phone):
+                session["last_heartbeat"] = _now()
+            elif session["last_heartbeat"] < cutoff:
+                await self._go_offline(phone, session)
+
+    async def flush(self):
+        now = _now()
+        refresh_before = now - timedelta(seconds=self.ttl / 3)
+        dirty, self.dirty = self.dirty, set()
+        ops = []
+        for phone, session in self.sessions.items():
+            stale = session["online"] and session.get("flushed_at", datetime.min.replace(tzinfo=timezone.utc)) < refresh_before
+            if phone not in dirty and not stale:
+                continue
+            ops.append(UpdateOne(
+                {"phone_number": phone},
+                {"$set": {"online": session["online"], "last_seen": session["last_seen"], "last_heartbeat": now}},
+                upsert=True
+            ))
+            session["flushed_at"] = now
+        if not ops:
+            return
+        try:
+            await presence_collection.bulk_write(ops, ordered=False)
+        except Exception:
+            self.dirty |= dirty
+            raise
@@ -1,7 +1,13 @@
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from models import update_user_profile, get_current_user, users_collection, is_user_online
-from firebase_utils import upload_image_to_firebase
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request, Query
+from models import update_user_profile, get_current_user, users_collection
+from cache import invalidate_user
+from conversations import get_friends_summary
+from chat import presence
+from storage import (
+    MAX_IMAGE_BYTES, checked_upload_file, store_profile_image,
+    create_upload_session, upload_offset, append_upload_chunks, complete_upload
+)
 from schema import ProfileUpdateResponse, UserResponse
 from models import chats_collection
 from fastapi import Body
@@ -11,37 +17,23 @@ router = APIRouter()
 @router.get("/friends_summary/")
 async def friends_summary(user: dict = Depends(get_current_user)):
     my_phone = user["phone_number"]
-    user_doc = users_collection.find_one({"phone_number": my_phone})
-    if not user_doc:
-        raise HTTPException(status_code=404, detail="User not found")
-    friends = user_doc.get("friends", [])
+    # get_current_user's document is dropped from the cache whenever the friends list changes
+    friends = user.get("friends", [])
+    summary = await get_friends_summary(my_phone, friends, with_profiles=True)
     result = []
     for friend in friends:
-        friend_user = users_collection.find_one({"phone_number": friend}) or {}
-        last_msg = chats_collection.find_one(
-            {"$or": [
-                {"from": my_phone, "to": friend},
-                {"from": friend, "to": my_phone}
-            ]},
-            sort=[("time", -1)]
-        )
-
-        unread_count = chats_collection.count_documents({
-        "from": friend,
-        "to": my_phone,
-        "status": {"$in": ["sent", "delivered"]}
-        })
-
+        entry = summary[friend]
         result.append({
             "phone_number": friend,
-            "username": friend_user.get("username", ""),
-            "profile_image_url": friend_user.get("profile_image_url", ""),
-            "bio": friend_user.get("bio", ""),
-            "email": friend_user.get("email", ""),
-            "last_message": last_msg["message"] if last_msg else "",
-            "last_message_time": last_msg["time"] if last_msg else "",
-            "last_message_status": last_msg["status"] if last_msg else "",
-            "unread": unread_count,
+            "username": entry["username"],
+            "profile_image_url": entry["profile_image_url"],
+            "profile_image_small_url": entry["profile_image_small_url"],
+            "bio": entry["bio"],
+            "email": entry["email"],
+            "last_message": entry["last_message"],
+            "last_message_time": entry["last_message_time"],
+            "last_message_status": entry["last_message_status"],
+            "unread": entry["unread"],
         })
     return result
 
@@ -79,21 +71,42 @@ async def update_profile(
         username_changed = True  # <-- Set flag
 
     if image:
-        content = await image.read()
-        if image.filename and "." in image.filename:
-            ext = image.filename.split(".")[-1]
-        else:
-            ext = ""
-        image_url = upload_image_to_firebase(content, ext)
-        update_data["profile_image_url"] = image_url
+        # Type comes from the bytes, not the filename; the form closes the file afterwards
+        update_data.update(await store_profile_image(checked_upload_file(image)))
 
-    updated_user = update_user_profile(phone_number, update_data)
+    updated_user = await update_user_profile(phone_number, update_data)
     return {
         "message": "Profile updated successfully" if username_changed else "Username cannot be changed until 15 days",
         "user": updated_user,
         "username_changed": username_changed  # <-- Add this to response
     }
 
+# Resumable upload: create a session, PUT chunks at the returned offset, then complete
+@router.post("/image_upload/")
+async def start_image_upload(user: dict = Depends(get_current_user)):
+    upload_id = create_upload_session(user["phone_number"])
+    return {"upload_id": upload_id, "offset": 0, "max_bytes": MAX_IMAGE_BYTES}
+
+@router.get("/image_upload/{upload_id}")
+async def image_upload_status(upload_id: str, user: dict = Depends(get_current_user)):
+    return {"upload_id": upload_id, "offset": upload_offset(user["phone_number"], upload_id)}
+
+@router.put("/image_upload/{upload_id}")
+async def upload_image_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    user: dict = Depends(get_current_user),
+):
+    new_offset = await append_upload_chunks(user["phone_number"], upload_id, offset, request.stream())
+    return {"upload_id": upload_id, "offset": new_offset}
+
+@router.post("/image_upload/{upload_id}/complete", response_model=ProfileUpdateResponse)
+async def finish_image_upload(upload_id: str, user: dict = Depends(get_current_user)):
+    image_fields = await complete_upload(user["phone_number"], upload_id)
+    updated_user = await update_user_profile(user["phone_number"], image_fields)
+    return {"message": "Profile image updated", "user": updated_user}
+
 @router.get("/me/", response_model=UserResponse)
 async def get_my_profile(user: dict = Depends(get_current_user)):
     user.setdefault("email", "")
@@ -107,12 +120,17 @@ async def update_fcm_token(
     fcm_token: str = Body(..., embed=True),
     user: dict = Depends(get_current_user)
 ):
-    users_collection.update_one(
+    await users_collection.update_one(
         {"phone_number": user["phone_number"]},
         {"$set": {"fcm_token": fcm_token}}
     )
+    await invalidate_user(user["phone_number"])
     return {"message": "FCM token updated"}
 
 @router.get("/online_status/{phone_number}")
 async def online_status(phone_number: str):
-    return {"online": is_user_online(phone_number)}
\ No newline at end of file
+    return {"online": await presence.is_online(phone_number)}
+
+@router.get("/friends_online_status/")
+async def friends_online_status(user: dict = Depends(get_current_user)):
+    return await presence.get_statuses(user.get("friends", []))
\ No newline at end of file
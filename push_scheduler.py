@@ -0,0 +1,48 @@
+import os
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+from metrics import log
+
+FRIENDS_UPDATE_DEBOUNCE_MS = float(os.getenv("FRIENDS_UPDATE_DEBOUNCE_MS", "250"))
+
+# push(user, changed) where changed is the set of conversations that changed, or None for everything
+PushHandler = Callable[[str, Optional[set]], Awaitable[None]]
+
+class DebouncedPushScheduler:
+    """Merges bursts of per-user change notifications into one push every `window` seconds."""
+
+    def __init__(self, push: PushHandler, window: float = FRIENDS_UPDATE_DEBOUNCE_MS / 1000):
+        self.push = push
+        self.window = window
+        self.pending: Dict[str, Optional[set]] = {}
+        self.requested = 0
+        self.sent = 0
+
+    def schedule(self, user: str, changed: Optional[Iterable[str]] = None):
+        """Queue a push for `user`; `changed=None` asks for a full summary."""
+        self.requested += 1
+        if user in self.pending:
+            current = self.pending[user]
+            if current is not None:
+                self.pending[user] = None if changed is None else current | set(changed)
+            return
+        self.pending[user] = None if changed is None else set(changed)
+        asyncio.get_running_loop().call_later(self.window, self._fire, user)
+
+    def _fire(self, user: str):
+        changed = self.pending.pop(user, None)
+        self.sent += 1
+        asyncio.create_task(self._push(user, changed))
+
+    async def _push(self, user: str, changed: Optional[set]):
+        try:
+            await self.push(user, changed)
+        except Exception as e:
+            log("summary_push.failed", phone=user, error=str(e))
+
+    def stats(self) -> dict:
+        return {
+            "requested": self.requested,
+            "sent": self.sent,
+            "saved": self.requested - self.sent - len(self.pending),
+        }
@@ -0,0 +1,226 @@
+import os
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from starlette.responses import JSONResponse
+from metrics import metrics, log, loop_lag
+from models import verify_token
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL") or os.getenv("MESSAGE_BUS_URL")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Number of reverse proxies in front of the app that append to X-Forwarded-For. Behind a
+# proxy or load balancer this must be set, or every client shares the proxy's address
+# (and with it the login and per-address limits).
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+# Event-loop lag (seconds) above which new work is shed
+LOAD_SHED_LAG = float(os.getenv("LOAD_SHED_LAG", "0.25"))
+
+# policy -> (tokens per second, burst)
+REST_POLICIES = {
+    "login": (0.2, 5),
+    "register": (0.05, 3),
+    "directory": (2, 10),
+    "upload": (1, 5),
+    # Each PUT of a resumable upload; the session itself is charged to "upload"
+    "upload_chunk": (10, 40),
+    # WebSocket handshakes per user, so reconnecting doesn't refill the frame buckets
+    "connect": (0.2, 5),
+    "rest": (20, 50),
+}
+FRAME_POLICIES = {
+    "message": (10, 30),
+    "group_message": (5, 15),
+    "typing": (4, 8),
+    "read_receipt": (20, 40),
+    "group_read": (20, 40),
+    "sync": (0.2, 2),
+    "friends_update_request": (1, 3),
+    "other": (10, 20),
+}
+# (method or None for any, path prefix, policy). Longest matching prefix wins, then a
+# method-specific entry; unauthenticated routes are keyed by client address
+REST_ROUTES = [
+    (None, "/auth/login/", "login"),
+    (None, "/auth/register/", "register"),
+    (None, "/friends/all_users", "directory"),
+    (None, "/profile/update/", "upload"),
+    (None, "/profile/image_upload/", "upload"),
+    ("PUT", "/profile/image_upload/", "upload_chunk"),
+    ("GET", "/profile/image_upload/", "rest"),
+]
+EXEMPT_PATHS = {"/", "/metrics"}
+# Frames dropped first when the loop is lagging; typing is dropped silently
+SHEDDABLE_FRAMES = {"typing", "friends_update_request", "sync"}
+
+def _parse_overrides(policies: dict, spec: Optional[str]) -> dict:
+    # "login=0.1:5,message=20:40"
+    policies = dict(policies)
+    for item in filter(None, (spec or "").split(",")):
+        name, _, values = item.partition("=")
+        rate, _, burst = values.partition(":")
+        policies[name.strip()] = (float(rate), float(burst or rate))
+    return policies
+
+class InMemoryLimiterBackend:
+    """Token buckets in this process, least recently used evicted past `max_keys`."""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        """Spend `cost` tokens; returns 0 if allowed, else seconds until it would be."""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / rate
+
+class RedisLimiterBackend:
+    """Token buckets shared by every worker; the refill and spend run atomically in one script."""
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local retry = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        retry = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return tostring(retry)
+    """
+
+    def __init__(self, url: str, prefix: str = "chitchat:ratelimit"):
+        import redis.asyncio as redis
+
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._script = self.redis.register_script(self.SCRIPT)
+
+    def _key(self, key: str) -> str:
+        # Keys are phone numbers and client addresses; don't store those in Redis
+        return f"{self.prefix}:{hashlib.sha1(key.encode()).hexdigest()}"
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        try:
+            return float(await self._script(keys=[self._key(key)], args=[rate, burst, cost]))
+        except Exception as e:
+            # Fail open: a Redis outage shouldn't take the API down with it
+            log("rate_limit.backend_failed", sample_rate=0.01, error=str(e))
+            return 0.0
+
+class RateLimiter:
+    def __init__(self, policies: Dict[str, Tuple[float, float]], backend):
+        self.policies = policies
+        self.backend = backend
+
+    async def check(self, policy: str, key: str) -> float:
+        """0 if the request may proceed, else the suggested Retry-After in seconds."""
+        rate, burst = self.policies[policy]
+        retry_after = await self.backend.take(f"{policy}:{key}", rate, burst)
+        if retry_after:
+            metrics.inc("rate_limited_total", policy=policy)
+        return retry_after
+
+def overloaded() -> bool:
+    return loop_lag.lag > LOAD_SHED_LAG
+
+def shed(kind: str) -> bool:
+    """True (and counted) if work of this kind should be refused because the loop is lagging."""
+    if not overloaded():
+        return False
+    metrics.inc("load_shed_total", kind=kind)
+    return True
+
+rest_limiter = RateLimiter(
+    _parse_overrides(REST_POLICIES, os.getenv("RATE_LIMITS_REST")),
+    RedisLimiterBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_BACKEND == "redis" and RATE_LIMIT_REDIS_URL else InMemoryLimiterBackend(),
+)
+# A socket's frames all arrive at the worker holding it, so per-connection buckets stay
+# local; closed connections' buckets simply age out of the LRU
+frame_limiter = RateLimiter(_parse_overrides(FRAME_POLICIES, os.getenv("RATE_LIMITS_WS")), InMemoryLimiterBackend())
+
+def rest_policy(path: str, method: str = "GET") -> str:
+    matches = [
+        ((len(prefix), route_method is not None), policy)
+        for route_method, prefix, policy in REST_ROUTES
+        if path.startswith(prefix) and route_method in (None, method)
+    ]
+    return max(matches)[1] if matches else "rest"
+
+_proxy_warned = False
+
+def client_address(scope, headers: dict) -> str:
+    """The caller's address: the entry RATE_LIMIT_PROXY_HOPS from the right of X-Forwarded-For
+    (anything further left is client-supplied), else the socket peer."""
+    global _proxy_warned
+    forwarded = headers.get(b"x-forwarded-for")
+    if forwarded:
+        hops = [h.strip() for h in forwarded.decode("latin-1").split(",")]
+        if RATE_LIMIT_PROXY_HOPS and len(hops) >= RATE_LIMIT_PROXY_HOPS:
+            return hops[-RATE_LIMIT_PROXY_HOPS]
+        if not RATE_LIMIT_PROXY_HOPS and not _proxy_warned:
+            _proxy_warned = True
+            log("rate_limit.proxy_not_configured", detail="X-Forwarded-For seen but RATE_LIMIT_PROXY_HOPS=0; limiting by proxy address")
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+def client_key(scope, use_token: bool = True) -> str:
+    """The verified user for authenticated calls, otherwise the client address.
+
+    An invalid or forged token counts as no token, so minting random ones doesn't buy fresh buckets.
+    """
+    headers = dict(scope.get("headers") or [])
+    auth = headers.get(b"authorization", b"")
+    if use_token and auth.lower().startswith(b"bearer "):
+        phone_number = verify_token(auth[7:].decode("latin-1"))
+        if phone_number:
+            return "user:" + phone_number
+    return "ip:" + client_address(scope, headers)
+
+class RateLimitMiddleware:
+    """Per-route token buckets for REST calls, plus load shedding while the event loop lags."""
+
+    def __init__(self, app, limiter: RateLimiter = rest_limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+        if shed("http"):
+            response = JSONResponse({"detail": "Server busy, please try again"}, status_code=503, headers={"Retry-After": "1"})
+            return await response(scope, receive, send)
+        policy = rest_policy(scope["path"], scope["method"])
+        # Logins are limited per address, so a token can't be used to dodge them
+        key = client_key(scope, use_token=policy not in ("login", "register"))
+        retry_after = await self.limiter.check(policy, key)
+        if retry_after:
+            response = JSONResponse(
+                {"detail": "Too many requests"}, status_code=429,
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+            return await response(scope, receive, send)
+        await self.app(scope, receive, send)
@@ -0,0 +1,311 @@
+import os
+import gzip
+import uuid
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+from starlette.concurrency import run_in_threadpool
+import codec
+from models import db, chats_collection
+from conversations import conversations_collection, get_conversation_page, HISTORY_PROJECTION
+from cache import TTLCache
+from metrics import metrics, log
+
+# Messages older than this move from `chats` into compressed archive segments (0 disables;
+# ARCHIVE_ROOT must then be durable storage shared by every worker)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+# Messages older than this are deleted everywhere, archive included (0 keeps them forever)
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "0"))
+ARCHIVE_ROOT = os.getenv("ARCHIVE_ROOT", "./archive")
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", "1000"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+# Pause between delete batches so a big purge doesn't monopolise the primary
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", "0.05"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Run the background worker on one process only when several workers share the database
+RETENTION_WORKER = os.getenv("RETENTION_WORKER", "1") == "1"
+
+# {_id, conversation_id, first_time, first_id, last_time, last_id, count, path}
+archive_segments_collection = db["archive_segments"]
+# {_id: conversation_id, before: iso time, created_at, purged_at}; everything at or before `before` is deleted
+tombstones_collection = db["tombstones"]
+
+segment_cache = TTLCache(maxsize=int(os.getenv("ARCHIVE_SEGMENT_CACHE_SIZE", "64")), ttl=300)
+
+def _cutoff(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+
+def _position(msg: dict) -> tuple:
+    return msg["time"], str(msg["_id"])
+
+def _project(msg: dict, projection: dict) -> dict:
+    return {k: v for k, v in msg.items() if projection.get(k)}
+
+class LocalArchive:
+    """gzip'd JSON-lines segment files under ARCHIVE_ROOT, one directory per conversation."""
+
+    def __init__(self, root: str = ARCHIVE_ROOT):
+        self.root = root
+
+    def write(self, cid: str, segment_id: str, messages: list) -> str:
+        safe_cid = "".join(c for c in cid if c.isalnum() or c in "_-")
+        path = os.path.join(self.root, safe_cid, f"{segment_id}.jsonl.gz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            for msg in messages:
+                f.write(codec.dumps(msg) + "\n")
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, path: str) -> list:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [codec.loads(line) for line in f if line.strip()]
+
+    def delete(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+archive = LocalArchive()
+
+async def _read_segment(segment: dict) -> list:
+    messages = segment_cache.get(segment["_id"])
+    if messages is None:
+        messages = await run_in_threadpool(archive.read, segment["path"])
+        segment_cache.set(segment["_id"], messages)
+    return messages
+
+async def get_tombstone(cid: str) -> Optional[str]:
+    tombstone = await tombstones_collection.find_one({"_id": cid}, {"before": 1})
+    return tombstone["before"] if tombstone else None
+
+async def get_tombstones(cids) -> dict:
+    """{conversation_id: before} for whichever of `cids` have been deleted."""
+    return {t["_id"]: t["before"] async for t in tombstones_collection.find({"_id": {"$in": list(set(cids))}}, {"before": 1})}
+
+async def _archived_before(cid: str, position, limit: int, floor: Optional[str]) -> list:
+    """Up to `limit` archived messages older than `position` (newest of them), oldest first."""
+    query = {"conversation_id": cid}
+    if position is not None:
+        query["first_time"] = {"$lte": position[0]}
+    if floor:
+        query["last_time"] = {"$gt": floor}
+    found = []
+    async for segment in archive_segments_collection.find(query).sort("last_time", -1):
+        older = [
+            m for m in await _read_segment(segment)
+            if (position is None or _position(m) < position) and (not floor or m["time"] > floor)
+        ]
+        found = older + found
+        if len(found) >= limit:
+            break
+    found.sort(key=_position)
+    return found[-limit:]
+
+async def _archived_after(cid: str, position, limit: int, floor: Optional[str]) -> list:
+    query = {"conversation_id": cid, "last_time": {"$gte": max(position[0], floor or "")}}
+    found = []
+    async for segment in archive_segments_collection.find(query).sort("first_time", 1):
+        found += [
+            m for m in await _read_segment(segment)
+            if _position(m) > position and (not floor or m["time"] > floor)
+        ]
+        if len(found) >= limit:
+            break
+    found.sort(key=_position)
+    return found[:limit]
+
+def _merge(*pages: list) -> list:
+    # A crash between writing a segment and deleting its messages leaves both copies
+    seen = {}
+    for page in pages:
+        for msg in page:
+            seen[str(msg["_id"])] = msg
+    return sorted(seen.values(), key=_position)
+
+async def get_history_page(cid: str, limit: int, before=None, after=None, projection: dict = HISTORY_PROJECTION) -> list:
+    """Like conversations.get_conversation_page, but hides deleted messages and falls through to the archive."""
+    floor = await get_tombstone(cid)
+    if after is not None:
+        archived = [_project(m, projection) for m in await _archived_after(cid, after, limit, floor)]
+        live = await get_conversation_page(cid, limit, after=after, projection=projection, floor=floor)
+        return _merge(archived, live)[:limit]
+
+    live = await get_conversation_page(cid, limit, before=before, projection=projection, floor=floor)
+    # Archived messages are normally all older than live ones, so a full live page is usually
+    # the answer; one indexed lookup confirms nothing archived falls inside it
+    if len(live) >= limit and not await archive_segments_collection.find_one(
+        {"conversation_id": cid, "last_time": {"$gte": live[0]["time"]}}, {"_id": 1}
+    ):
+        return live
+    archived = [_project(m, projection) for m in await _archived_before(cid, before, limit, floor)]
+    return _merge(archived, live)[-limit:]
+
+async def iter_history(cid: str, projection: dict = HISTORY_PROJECTION, batch_size: int = 500):
+    """Every visible message in the conversation, oldest first: archive segments, then `chats`
+    (archive_conversation never archives past a message it leaves live)."""
+    floor = await get_tombstone(cid)
+    seen = set()
+    async for segment in archive_segments_collection.find({"conversation_id": cid}).sort("first_time", 1):
+        for msg in await _read_segment(segment):
+            if not floor or msg["time"] > floor:
+                seen.add(str(msg["_id"]))
+                yield _project(msg, projection)
+    query = {"conversation_id": cid}
+    if floor:
+        query["time"] = {"$gt": floor}
+    async for msg in chats_collection.find(query, projection).sort([("time", 1), ("_id", 1)]).batch_size(batch_size):
+        if str(msg["_id"]) not in seen:
+            yield msg
+
+async def delete_conversation_history(cid: str) -> str:
+    """Logically delete everything in the conversation so far; the messages are purged in the background."""
+    now = datetime.now(timezone.utc).isoformat()
+    await tombstones_collection.update_one(
+        {"_id": cid},
+        {"$set": {"before": now, "created_at": now, "purged_at": None}},
+        upsert=True
+    )
+    return now
+
+async def _delete_in_batches(query: dict, counter: str) -> int:
+    deleted = 0
+    while True:
+        ids = [m["_id"] async for m in chats_collection.find(query, {"_id": 1}).limit(PURGE_BATCH_SIZE)]
+        if not ids:
+            return deleted
+        result = await chats_collection.delete_many({"_id": {"$in": ids}})
+        deleted += result.deleted_count
+        metrics.inc(counter, result.deleted_count)
+        await asyncio.sleep(PURGE_PAUSE)
+
+async def _delete_segments(query: dict):
+    async for segment in archive_segments_collection.find(query, {"path": 1}):
+        await run_in_threadpool(archive.delete, segment["path"])
+        await archive_segments_collection.delete_one({"_id": segment["_id"]})
+        segment_cache.pop(segment["_id"])
+
+async def purge_tombstones() -> int:
+    """Physically remove messages hidden by tombstones, a batch at a time."""
+    purged = 0
+    async for tombstone in tombstones_collection.find({"purged_at": None}):
+        cid, before = tombstone["_id"], tombstone["before"]
+        purged += await _delete_in_batches({"conversation_id": cid, "time": {"$lte": before}}, "purged_messages_total")
+        # Segments that straddle the tombstone stay; reads filter them
+        await _delete_segments({"conversation_id": cid, "last_time": {"$lte": before}})
+        await tombstones_collection.update_one(
+            {"_id": cid, "before": before},
+            {"$set": {"purged_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    return purged
+
+async def archive_conversation(cid: str, cutoff: str) -> int:
+    """Move messages older than `cutoff` into segments.
+
+    Undelivered messages stay so the offline drain still sees them, and so does everything after
+    the oldest of them: archived messages are then always older than live ones, which keeps
+    history pages and exports in order.
+    """
+    archived = 0
+    unsettled = await chats_collection.find_one(
+        {"conversation_id": cid, "status": "sent", "time": {"$lt": cutoff}}, {"time": 1}, sort=[("time", 1)]
+    )
+    if unsettled:
+        cutoff = unsettled["time"]
+    query = {"conversation_id": cid, "time": {"$lt": cutoff}}
+    while True:
+        messages = await (
+            chats_collection.find(query)
+            .sort([("time", 1), ("_id", 1)])
+            .limit(ARCHIVE_SEGMENT_SIZE)
+            .to_list(length=ARCHIVE_SEGMENT_SIZE)
+        )
+        if not messages:
+            return archived
+        segment_id = uuid.uuid4().hex
+        # File first, then its index entry, then the delete: a crash leaves duplicates, never a gap
+        path = await run_in_threadpool(archive.write, cid, segment_id, messages)
+        await archive_segments_collection.insert_one({
+            "_id": segment_id,
+            "conversation_id": cid,
+            "first_time": messages[0]["time"],
+            "first_id": str(messages[0]["_id"]),
+            "last_time": messages[-1]["time"],
+            "last_id": str(messages[-1]["_id"]),
+            "count": len(messages),
+            "path": path,
+        })
+        await chats_collection.delete_many({"_id": {"$in": [m["_id"] for m in messages]}})
+        archived += len(messages)
+        metrics.inc("archived_messages_total", len(messages))
+        await asyncio.sleep(PURGE_PAUSE)
+
+async def expire_conversation(cid: str, cutoff: str) -> int:
+    expired = await _delete_in_batches({"conversation_id": cid, "time": {"$lt": cutoff}}, "expired_messages_total")
+    await _delete_segments({"conversation_id": cid, "last_time": {"$lt": cutoff}})
+    return expired
+
+async def run_retention_pass() -> dict:
+    """Purge tombstoned chats, then expire and archive per conversation (each an indexed range on conversation_time_id)."""
+    stats = {"purged": await purge_tombstones(), "expired": 0, "archived": 0}
+    if not (ARCHIVE_AFTER_DAYS or MESSAGE_RETENTION_DAYS):
+        return stats
+    expire_cutoff = _cutoff(MESSAGE_RETENTION_DAYS) if MESSAGE_RETENTION_DAYS else None
+    archive_cutoff = _cutoff(ARCHIVE_AFTER_DAYS) if ARCHIVE_AFTER_DAYS else None
+    async for conv in conversations_collection.find({}, {"_id": 1}):
+        if expire_cutoff:
+            stats["expired"] += await expire_conversation(conv["_id"], expire_cutoff)
+        if archive_cutoff:
+            stats["archived"] += await archive_conversation(conv["_id"], archive_cutoff)
+    return stats
+
+class RetentionWorker:
+    def __init__(self, interval: float = RETENTION_INTERVAL, enabled: bool = RETENTION_WORKER):
+        self.interval = interval
+        self.enabled = enabled
+        self._task = None
+        self._wake = asyncio.Event()
+
+    def wake(self):
+        """Purge tombstones now, e.g. right after a chat was deleted; the full pass keeps its schedule."""
+        self._wake.set()
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_full_pass = loop.time()
+        while True:
+            self._wake.clear()
+            try:
+                if loop.time() >= next_full_pass:
+                    next_full_pass = loop.time() + self.interval
+                    stats = await run_retention_pass()
+                else:
+                    stats = {"purged": await purge_tombstones()}
+                if any(stats.values()):
+                    log("retention.pass", **stats)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log("retention.failed", error=str(e))
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, next_full_pass - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+retention_worker = RetentionWorker()
+
+if __name__ == "__main__":
+    # python retention.py  -> one purge/expire/archive pass, e.g. from cron with RETENTION_WORKER=0 on the app
+    print(asyncio.run(run_retention_pass()))
@@ -8,6 +8,8 @@ class UserResponse(BaseModel):
     email:str
     bio: Optional[str] = ""
     profile_image_url: Optional[str] = ""
+    profile_image_small_url: Optional[str] = ""
+    profile_image_medium_url: Optional[str] = ""
     friends: Optional[List[str]] = [] 
 
     class Config:
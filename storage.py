@@ -0,0 +1,219 @@
+import os
+import io
+import time
+import uuid
+import fcntl
+import shutil
+import tempfile
+from typing import Optional
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from metrics import log
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are skipped without Pillow
+    Image = None
+
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "firebase")
+LOCAL_MEDIA_ROOT = os.getenv("LOCAL_MEDIA_ROOT", "./media")
+LOCAL_MEDIA_URL = os.getenv("LOCAL_MEDIA_URL", "/media")
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", os.path.join(tempfile.gettempdir(), "chitchat_uploads"))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(5 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Sessions untouched for this long are abandoned; they're refused and swept
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", "86400"))
+UPLOAD_SWEEP_INTERVAL = float(os.getenv("UPLOAD_SWEEP_INTERVAL", "600"))
+THUMBNAIL_SIZES = {"small": 64, "medium": 256}
+
+# Magic numbers of the formats we accept, mapped to file extension
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+class LocalStorage:
+    """Writes images under LOCAL_MEDIA_ROOT; main.py serves them at LOCAL_MEDIA_URL."""
+
+    def __init__(self, root: str = LOCAL_MEDIA_ROOT, base_url: str = LOCAL_MEDIA_URL):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+
+    def save(self, key: str, fileobj, content_type: str) -> str:
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fileobj, f, UPLOAD_CHUNK_SIZE)
+        return f"{self.base_url}/{key}"
+
+class FirebaseStorage:
+    def save(self, key: str, fileobj, content_type: str) -> str:
+        from firebase_utils import upload_file_to_firebase
+        return upload_file_to_firebase(fileobj, key, content_type)
+
+_storage = None
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = LocalStorage() if IMAGE_STORAGE == "local" else FirebaseStorage()
+    return _storage
+
+def checked_upload_file(upload: UploadFile):
+    """The upload's file, refused with 413 if over MAX_IMAGE_BYTES.
+
+    Starlette's multipart parser has already spooled the body by now, so this checks the spooled
+    size instead of copying it again.
+    """
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    if size > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+    return upload.file
+
+def _make_thumbnail(fileobj, size: int) -> io.BytesIO:
+    fileobj.seek(0)
+    with Image.open(fileobj) as img:
+        img.thumbnail((size, size))
+        thumb = io.BytesIO()
+        img.convert("RGB").save(thumb, format="JPEG", quality=85)
+    thumb.seek(0)
+    return thumb
+
+def _store_profile_image(fileobj) -> dict:
+    fileobj.seek(0)
+    ext = sniff_image_type(fileobj.read(16))
+    if ext is None:
+        raise HTTPException(status_code=415, detail="Unsupported image type")
+    storage = get_storage()
+    image_id = uuid.uuid4()
+    fileobj.seek(0)
+    urls = {"profile_image_url": storage.save(f"profile_images/{image_id}.{ext}", fileobj, f"image/{ext}")}
+    if Image is not None:
+        for name, size in THUMBNAIL_SIZES.items():
+            try:
+                thumb = _make_thumbnail(fileobj, size)
+            except Exception as e:
+                log("storage.thumbnail_failed", size=name, error=str(e))
+                continue
+            urls[f"profile_image_{name}_url"] = storage.save(
+                f"profile_images/{image_id}_{name}.jpeg", thumb, "image/jpeg"
+            )
+    return urls
+
+async def store_profile_image(fileobj) -> dict:
+    """Sniff, store and thumbnail an image off the event loop; returns the user fields to set."""
+    return await run_in_threadpool(_store_profile_image, fileobj)
+
+# --- Resumable uploads: chunks are appended to a per-session temp file until completed ---
+
+def _session_path(owner: str, upload_id: str) -> str:
+    # The owner is part of the path so nobody can append to someone else's upload
+    safe_owner = "".join(c for c in owner if c.isalnum())
+    return os.path.join(UPLOAD_TMP_DIR, f"{safe_owner}_{upload_id}.part")
+
+def _expired(path: str) -> bool:
+    return time.time() - os.path.getmtime(path) > UPLOAD_SESSION_TTL
+
+def _checked_session_path(owner: str, upload_id: str) -> str:
+    try:
+        uuid.UUID(upload_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    path = _session_path(owner, upload_id)
+    try:
+        if not _expired(path):
+            return path
+    except FileNotFoundError:
+        pass
+    raise HTTPException(status_code=404, detail="Upload not found")
+
+def _open_locked(path: str, mode: str):
+    """Open a session file holding its lock, so chunks, completion and the sweep never overlap."""
+    try:
+        # O_APPEND without O_CREAT: a completed or swept session must not come back
+        flags = os.O_WRONLY | os.O_APPEND if mode == "ab" else os.O_RDONLY
+        f = os.fdopen(os.open(path, flags), mode)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise HTTPException(status_code=409, detail="Upload in progress")
+    if os.fstat(f.fileno()).st_nlink == 0:
+        # Completed or swept between the open and the lock
+        f.close()
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return f
+
+_last_sweep = 0.0
+
+def sweep_upload_sessions() -> int:
+    """Delete sessions idle for longer than UPLOAD_SESSION_TTL; returns how many."""
+    removed = 0
+    try:
+        names = os.listdir(UPLOAD_TMP_DIR)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(UPLOAD_TMP_DIR, name)
+        try:
+            if not name.endswith(".part") or not _expired(path):
+                continue
+            with _open_locked(path, "rb"):
+                os.remove(path)
+            removed += 1
+        except (OSError, HTTPException):
+            continue  # in use, or already gone
+    if removed:
+        log("storage.upload_sessions_swept", removed=removed)
+    return removed
+
+def create_upload_session(owner: str) -> str:
+    global _last_sweep
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    # Sessions only appear here, so sweeping here keeps every host's temp dir bounded
+    if time.monotonic() - _last_sweep > UPLOAD_SWEEP_INTERVAL:
+        _last_sweep = time.monotonic()
+        sweep_upload_sessions()
+    upload_id = str(uuid.uuid4())
+    open(_session_path(owner, upload_id), "wb").close()
+    return upload_id
+
+def upload_offset(owner: str, upload_id: str) -> int:
+    return os.path.getsize(_checked_session_path(owner, upload_id))
+
+async def append_upload_chunks(owner: str, upload_id: str, offset: int, chunks) -> int:
+    """Append a streamed request body at `offset`; returns the new offset."""
+    path = _checked_session_path(owner, upload_id)
+    with _open_locked(path, "ab") as f:
+        # Checked under the lock, so two PUTs at the same offset can't both pass
+        current = os.fstat(f.fileno()).st_size
+        if offset != current:
+            raise HTTPException(status_code=409, detail=f"Expected offset {current}")
+        async for chunk in chunks:
+            current += len(chunk)
+            if current > MAX_IMAGE_BYTES:
+                raise HTTPException(status_code=413, detail="Image too large")
+            await run_in_threadpool(f.write, chunk)
+    return current
+
+async def complete_upload(owner: str, upload_id: str) -> dict:
+    path = _checked_session_path(owner, upload_id)
+    with _open_locked(path, "rb") as f:
+        try:
+            return await store_profile_image(f)
+        finally:
+            os.remove(path)
@@ -0,0 +1,87 @@
+import time
+import asyncio
+from connections import Connection
+
+class StalledSocket:
+    """A client that stopped reading: every send blocks until the writer gives up."""
+
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data):
+        await asyncio.Event().wait()
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data):
+        self.sent.append((time.perf_counter(), data))
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+def test_stalled_client_does_not_delay_others_and_is_disconnected():
+    async def scenario():
+        stalled_socket, healthy_socket = StalledSocket(), RecordingSocket()
+        stalled = Connection(stalled_socket, max_size=4, send_timeout=60)
+        healthy = Connection(healthy_socket, max_size=4, send_timeout=60)
+        await _settle()
+
+        # The writer takes one frame and blocks on it; the queue then fills up
+        pushed_at = []
+        for i in range(5):
+            started = time.perf_counter()
+            assert stalled.push({"type": "message", "n": i})
+            # Pushing never waits on the socket
+            assert time.perf_counter() - started < 0.05
+            pushed_at.append(time.perf_counter())
+            assert healthy.push({"type": "message", "n": i})
+            await _settle()
+
+        # Other users' frames went out straight away despite the stalled socket
+        assert len(healthy_socket.sent) == 5
+        assert max(sent - pushed for (sent, _), pushed in zip(healthy_socket.sent, pushed_at)) < 0.05
+        assert not stalled.closed
+
+        # Nothing ephemeral to drop, so one more frame disconnects the slow consumer
+        assert not stalled.push({"type": "message", "n": 5})
+        await _settle()
+        assert stalled.closed
+        assert stalled_socket.close_code == 1013
+        assert not healthy.closed
+
+        healthy.close()
+        await _settle()
+
+    asyncio.run(scenario())
+
+def test_full_queue_drops_typing_before_disconnecting():
+    async def scenario():
+        socket = StalledSocket()
+        connection = Connection(socket, max_size=2, send_timeout=60)
+        await _settle()
+        assert connection.push({"type": "message", "n": 0})
+        await _settle()
+        assert connection.push({"type": "typing"}, ephemeral=True)
+        assert connection.push({"type": "message", "n": 1})
+
+        # Full: a new typing frame is dropped, a message evicts the queued typing frame
+        assert not connection.push({"type": "typing"}, ephemeral=True)
+        assert connection.push({"type": "message", "n": 2})
+        assert connection.dropped == 2
+        assert not connection.closed
+
+        connection.close()
+        await _settle()
+
+    asyncio.run(scenario())
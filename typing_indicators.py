@@ -0,0 +1,127 @@
+import os
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple
+from metrics import log
+
+TYPING_TIMEOUT = float(os.getenv("TYPING_TIMEOUT", "5"))
+TYPING_MIN_INTERVAL = float(os.getenv("TYPING_MIN_INTERVAL", "0.3"))
+
+# send(sender, receiver, is_typing) forwards one ephemeral typing frame
+TypingSender = Callable[[str, str, bool], Awaitable[None]]
+
+class TypingRelay:
+    """Forwards typing indicators only when they change state, at most once per `min_interval`
+    per (sender, receiver), and sends "stopped typing" itself when a sender goes quiet.
+
+    Nothing here is persisted; repeated "still typing" frames only push the expiry back. A start
+    that comes too soon after a stop is deferred to the end of the interval rather than dropped,
+    since clients only send state changes and the indicator would otherwise never appear.
+    """
+
+    def __init__(self, send: TypingSender, timeout: float = TYPING_TIMEOUT, min_interval: float = TYPING_MIN_INTERVAL):
+        self.send = send
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.states: Dict[Tuple[str, str], dict] = {}
+        self.forwarded = 0
+        self.suppressed = 0
+        self._task = None
+        self._deferred = set()
+
+    async def update(self, sender: str, receiver: str, is_typing: bool):
+        key = (sender, receiver)
+        state = self.states.get(key)
+        now = time.monotonic()
+        if is_typing:
+            if state is not None and state["typing"]:
+                state["expires"] = now + self.timeout
+                self.suppressed += 1
+                return
+            if state is not None and now - state["last_sent"] < self.min_interval:
+                # Trailing edge: forward once the interval is up, if they're still typing then
+                state.update(typing=True, pending=True, expires=now + self.timeout)
+                task = asyncio.create_task(self._forward_later(key, state["last_sent"] + self.min_interval - now))
+                self._deferred.add(task)
+                task.add_done_callback(self._deferred.discard)
+                return
+            self.states[key] = {"typing": True, "pending": False, "last_sent": now, "expires": now + self.timeout}
+            await self._forward(sender, receiver, True)
+        else:
+            if state is None or not state["typing"]:
+                self.suppressed += 1
+                return
+            state["typing"] = False
+            if state["pending"]:
+                # The receiver never saw this start, so there is nothing to stop
+                state["pending"] = False
+                self.suppressed += 1
+                return
+            state["last_sent"] = now
+            await self._forward(sender, receiver, False)
+
+    async def _forward_later(self, key: Tuple[str, str], delay: float):
+        await asyncio.sleep(delay)
+        state = self.states.get(key)
+        if state is None or not state["pending"]:
+            return
+        state["pending"] = False
+        if state["typing"]:
+            state["last_sent"] = time.monotonic()
+            await self._forward(key[0], key[1], True)
+
+    def clear(self, sender: str, receiver: str):
+        """The sender's message arrived; the receiver's client stops the indicator on its own."""
+        state = self.states.get((sender, receiver))
+        if state is not None:
+            state["typing"] = False
+            state["pending"] = False
+
+    async def drop_sender(self, sender: str):
+        for key in [key for key in self.states if key[0] == sender]:
+            state = self.states.pop(key)
+            if state["typing"] and not state["pending"]:
+                await self._forward(sender, key[1], False)
+
+    async def _forward(self, sender: str, receiver: str, is_typing: bool):
+        self.forwarded += 1
+        try:
+            await self.send(sender, receiver, is_typing)
+        except Exception as e:
+            log("typing.forward_failed", error=str(e))
+
+    async def expire(self):
+        now = time.monotonic()
+        expired: List[Tuple[str, str]] = []
+        for key, state in list(self.states.items()):
+            if state["typing"] and state["expires"] <= now:
+                if state["pending"]:
+                    del self.states[key]
+                else:
+                    expired.append(key)
+            elif not state["typing"] and not state["pending"] and now - state["last_sent"] >= self.min_interval:
+                del self.states[key]
+        for sender, receiver in expired:
+            self.states.pop((sender, receiver), None)
+            await self._forward(sender, receiver, False)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in list(self._deferred):
+            task.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._deferred = set()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(self.timeout / 2, 1.0))
+            await self.expire()
+
+    def stats(self) -> dict:
+        return {"active": len(self.states), "forwarded": self.forwarded, "suppressed": self.suppressed}